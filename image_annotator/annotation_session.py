@@ -0,0 +1,263 @@
+# ------------------------------------------------------------------
+# Description: Long-lived annotation session for the substation viewer.
+# Captures land in a work-queue directory that is watched for new chips;
+# a single annotation window (a rectangle canvas built on CropLabel)
+# works through them and autosaves LabelMe JSON next to each image, so
+# no LabelMe process is spawned per capture. Reviewed chips move with their
+# JSON into Annotations, where they count as annotated.
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+import json
+import os
+import re
+
+from PyQt5.QtCore import QFileSystemWatcher, QPoint, QRect, Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QPainter, QPen, QPixmap
+from PyQt5.QtWidgets import (
+    QComboBox,
+    QHBoxLayout,
+    QLabel,
+    QListWidget,
+    QPushButton,
+    QVBoxLayout,
+    QWidget,
+)
+
+from prelabel import LABELME_VERSION, prelabel_marker_path
+from widgets import CropLabel
+
+work_queue_dir = Path("work_queue")
+annotations_dir = Path("Annotations")
+SCREENSHOT_IMAGE = re.compile(r"screenshot_(\d+)\.(png|webp|jpg|jpeg)$")
+CLASS_COLORS = [QColor(255, 80, 80), QColor(80, 200, 255), QColor(255, 210, 0)]
+
+
+class AnnotationCanvas(CropLabel):
+    # Left drag draws a rectangle with the current label, right click
+    # removes the box under the cursor. Shapes are kept in image pixels.
+    changed = pyqtSignal()
+
+    def __init__(self, parent=None, display_size=800):
+        super().__init__(QPixmap(), parent)
+        self.display_size = display_size
+        self.setFixedSize(display_size, display_size)
+        self.shapes = []
+        self.modified = False
+        self.classes = []
+        self.current_label = None
+        self.scale = 1.0
+
+    def load(self, pixmap, shapes):
+        self.scale = self.display_size / max(pixmap.width(), pixmap.height(), 1)
+        self.setPixmap(
+            pixmap.scaled(self.display_size, self.display_size, Qt.KeepAspectRatio,
+                          Qt.SmoothTransformation)
+        )
+        self.shapes = shapes
+        self.modified = False
+        self.start_point = QPoint()
+        self.end_point = QPoint()
+        self.update()
+
+    def to_image(self, point):
+        return [point.x() / self.scale, point.y() / self.scale]
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.RightButton:
+            x, y = self.to_image(event.pos())
+            for shape in reversed(self.shapes):
+                xs = [p[0] for p in shape["points"]]
+                ys = [p[1] for p in shape["points"]]
+                if min(xs) <= x <= max(xs) and min(ys) <= y <= max(ys):
+                    self.shapes.remove(shape)
+                    self.modified = True
+                    self.changed.emit()
+                    break
+            self.update()
+            return
+        super().mousePressEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        super().mouseReleaseEvent(event)
+        if event.button() != Qt.LeftButton or self.current_label is None:
+            return
+        rect = self.get_crop_rect()
+        if rect.width() > 3 and rect.height() > 3:
+            self.shapes.append({
+                "label": self.current_label,
+                "points": [self.to_image(rect.topLeft()), self.to_image(rect.bottomRight())],
+                "group_id": None,
+                "description": "",
+                "shape_type": "rectangle",
+                "flags": {},
+                "mask": None,
+            })
+            self.modified = True
+            self.changed.emit()
+        self.start_point = QPoint()
+        self.end_point = QPoint()
+        self.update()
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        painter = QPainter(self)
+        for shape in self.shapes:
+            label = shape["label"]
+            color = CLASS_COLORS[self.classes.index(label) % len(CLASS_COLORS)] \
+                if label in self.classes else QColor(Qt.white)
+            painter.setPen(QPen(color, 2))
+            points = [QPoint(int(x * self.scale), int(y * self.scale)) for x, y in shape["points"]]
+            if shape["shape_type"] == "rectangle":
+                painter.drawRect(QRect(points[0], points[1]).normalized())
+            else:
+                painter.drawPolygon(*points)
+            painter.drawText(points[0] + QPoint(2, -4), label)
+        painter.end()
+
+
+class AnnotationSession(QWidget):
+    annotated = pyqtSignal(int)
+
+    def __init__(self, classes, work_dir=work_queue_dir, done_dir=annotations_dir, parent=None):
+        super().__init__(parent, Qt.Window)
+        self.setWindowTitle("Annotation Session")
+        self.work_dir = Path(work_dir)
+        self.done_dir = Path(done_dir)
+        os.makedirs(self.work_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+        self.n_done = 0
+        self.current = None
+        self.pending = None
+
+        layout = QHBoxLayout(self)
+        side = QVBoxLayout()
+        self.queue_list = QListWidget()
+        self.queue_list.currentTextChanged.connect(self.open_image)
+        side.addWidget(self.queue_list)
+
+        self.label_box = QComboBox()
+        self.label_box.addItems(classes)
+        self.label_box.currentTextChanged.connect(self.set_label)
+        side.addWidget(self.label_box)
+
+        self.done_button = QPushButton("Done / Next")
+        self.done_button.clicked.connect(self.mark_done)
+        side.addWidget(self.done_button)
+
+        self.info_label = QLabel()
+        side.addWidget(self.info_label)
+        layout.addLayout(side)
+
+        self.canvas = AnnotationCanvas(self)
+        self.canvas.classes = list(classes)
+        self.canvas.current_label = classes[0] if classes else None
+        self.canvas.changed.connect(self.autosave)
+        layout.addWidget(self.canvas)
+
+        # New captures show up in the queue as soon as they are written
+        self.watcher = QFileSystemWatcher([str(self.work_dir)], self)
+        self.watcher.directoryChanged.connect(self.refresh)
+        self.refresh()
+
+    def set_label(self, label):
+        self.canvas.current_label = label
+
+    def image_files(self):
+        return sorted(
+            e.name for e in os.scandir(self.work_dir) if SCREENSHOT_IMAGE.match(e.name)
+        )
+
+    def ss_id(self, image_name):
+        return int(SCREENSHOT_IMAGE.match(image_name).group(1))
+
+    def refresh(self, *_):
+        # The watcher also fires for every autosave (.tmp write and rename);
+        # only a change in the set of images rebuilds the list, and the open
+        # image is reselected without signals so it is not reloaded.
+        pending = self.image_files()
+        current = self.current
+        if pending == self.pending and current is not None:
+            return
+        self.pending = pending
+        self.queue_list.blockSignals(True)
+        self.queue_list.clear()
+        self.queue_list.addItems(pending)
+        if current in pending:
+            self.queue_list.setCurrentRow(pending.index(current))
+        self.queue_list.blockSignals(False)
+        self.info_label.setText(f"{len(pending)} to review, {self.n_done} done")
+        if pending and current is None:
+            self.queue_list.setCurrentRow(0)
+
+    def enqueue(self, image_path):
+        # Captures are written into the work queue; show this one now
+        self.show()
+        self.raise_()
+        self.refresh()
+        name = os.path.basename(image_path)
+        items = self.queue_list.findItems(name, Qt.MatchExactly)
+        if items:
+            self.queue_list.setCurrentItem(items[0])
+
+    def json_path(self, image_name):
+        return self.work_dir / (os.path.splitext(image_name)[0] + ".json")
+
+    def open_image(self, image_name):
+        if not image_name:
+            return
+        self.current = image_name
+        pixmap = QPixmap(str(self.work_dir / image_name))
+        shapes = []
+        try:
+            # Pre-labeled boxes or an earlier autosave
+            with open(self.json_path(image_name), "r") as f:
+                shapes = json.load(f)["shapes"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+        self.image_size = (pixmap.width(), pixmap.height())
+        self.canvas.load(pixmap, shapes)
+
+    def reload_if_untouched(self, image_path):
+        # Pre-labels that arrive after the chip was opened
+        name = os.path.basename(image_path)
+        if name == self.current and not self.canvas.modified:
+            self.open_image(name)
+
+    def autosave(self):
+        if self.current is None:
+            return
+        data = {
+            "version": LABELME_VERSION,
+            "flags": {},
+            "shapes": self.canvas.shapes,
+            "imagePath": self.current,
+            "imageData": None,
+            "imageHeight": self.image_size[1],
+            "imageWidth": self.image_size[0],
+        }
+        path = self.json_path(self.current)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def mark_done(self):
+        if self.current is None:
+            return
+        self.autosave()
+        # Image first, then JSON: the JSON is what marks a substation annotated
+        os.replace(self.work_dir / self.current, self.done_dir / self.current)
+        json_name = self.json_path(self.current).name
+        meta_name = json_name[: -len(".json")] + ".meta.json"
+        if (self.work_dir / meta_name).exists():
+            os.replace(self.work_dir / meta_name, self.done_dir / meta_name)
+        os.replace(self.work_dir / json_name, self.done_dir / json_name)
+        marker = prelabel_marker_path(self.work_dir / json_name)
+        if os.path.exists(marker):
+            os.remove(marker)
+        self.n_done += 1
+        self.annotated.emit(self.ss_id(self.current))
+        self.current = None
+        self.refresh()
+
+# %%
@@ -0,0 +1,291 @@
+# ------------------------------------------------------------------
+# Description: Streaming batch inference over a directory of captures.
+# Image paths flow through a generator pipeline: a thread pool decodes
+# with cv2.imread a bounded number of images ahead of the model, frames
+# are batched into the YOLO call and detections are streamed to JSONL or
+# Parquet. Rendering of the boxes to disk is optional.
+#
+# python batch_inference.py Annotations --weights best.pt --out detections.jsonl
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import json
+import time
+
+import cv2
+import numpy as np
+
+from tracing import span
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+parent_dir = Path(__file__).resolve().parent.parent
+best_weights_path = parent_dir / "runs/detect/train5/weights/best.pt"
+
+
+def iter_image_paths(inputs):
+    for item in inputs:
+        item = Path(item)
+        if item.is_dir():
+            for root, _, files in os.walk(item):
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        elif item.suffix == '.txt':
+            # A list of image paths, one per line (e.g. dataset/val.txt)
+            with open(item, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        yield line.strip()
+        else:
+            yield str(item)
+
+
+def prefetch_decode(paths, workers=4, prefetch=32):
+    # Keep at most `prefetch` decodes in flight so memory stays bounded
+    # while decode overlaps with the model
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(cv2.imread, path)))
+            if len(pending) >= prefetch:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def result_to_detections(result):
+    return (
+        result.boxes.xyxy.cpu().numpy(),
+        result.boxes.cls.cpu().numpy(),
+        result.boxes.conf.cpu().numpy(),
+    )
+
+
+def detections_to_record(path, image_shape, boxes, classes, confidences, names):
+    return {
+        'image': str(path),
+        'height': int(image_shape[0]),
+        'width': int(image_shape[1]),
+        'boxes': np.round(boxes, 2).tolist(),
+        'classes': [int(c) for c in classes],
+        'names': [names[int(c)] for c in classes],
+        'confidences': np.round(confidences, 4).tolist(),
+    }
+
+
+def draw_detections(image, boxes, classes, confidences, names):
+    for box, cls, conf in zip(boxes, classes, confidences):
+        x1, y1, x2, y2 = box.astype(int)
+        label = f"{names[int(cls)]}: {conf:.2f}"
+        cv2.rectangle(image, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(
+            image, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2
+        )
+    return image
+
+
+class DetectionWriter:
+    # Closing flushes buffered rows and, for Parquet, writes the footer;
+    # use as a context manager so that also happens when inference fails
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonlWriter(DetectionWriter):
+    def __init__(self, path):
+        self.f = open(path, 'w')
+
+    def write(self, record):
+        self.f.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter(DetectionWriter):
+    # One row per detection, flushed in row groups. An image without
+    # detections gets a single row with null box columns, so the file also
+    # records which images were processed.
+    def __init__(self, path, row_group_size=50000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([
+            ('image', pa.string()),
+            ('x1', pa.float32()), ('y1', pa.float32()),
+            ('x2', pa.float32()), ('y2', pa.float32()),
+            ('class_id', pa.int16()),
+            ('name', pa.string()),
+            ('confidence', pa.float32()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def write(self, record):
+        for box, cls, name, conf in zip(
+            record['boxes'], record['classes'], record['names'], record['confidences']
+        ):
+            self.rows.append((record['image'], *box, cls, name, conf))
+        if not record['boxes']:
+            self.rows.append((record['image'],) + (None,) * (len(self.schema) - 1))
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            columns = list(zip(*self.rows))
+            self.writer.write_table(self.pa.Table.from_arrays(
+                [self.pa.array(c, type=f.type) for c, f in zip(columns, self.schema)],
+                schema=self.schema,
+            ))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_writer(path):
+    if str(path).endswith('.parquet'):
+        return ParquetWriter(path)
+    return JsonlWriter(path)
+
+
+def predict_batches(model, frames, batch_size=16, imgsz=640, conf=0.25, device=None,
+                    sliced=False, tile_size=640, cascade=None):
+    for batch in batched(frames, batch_size):
+        images = [image for _, image in batch]
+        with span('inference.predict', images=len(images), sliced=sliced):
+            if cascade is None:
+                detections = predict_images(model, images, imgsz, conf, device, sliced,
+                                            tile_size, batch_size)
+            else:
+                # Only chips the classifier screen lets through reach the detector
+                detections = cascade.predict(images, lambda kept: predict_images(
+                    model, kept, imgsz, conf, device, sliced, tile_size, batch_size))
+        for (path, image), det in zip(batch, detections):
+            yield path, image, det
+
+
+def predict_images(model, images, imgsz, conf, device, sliced, tile_size, batch_size):
+    if sliced:
+        from sliced_inference import sliced_predict
+
+        return [
+            sliced_predict(model, image, tile_size=tile_size, batch_size=batch_size,
+                           conf=conf, verbose=False, device=device)
+            for image in images
+        ]
+    results = model.predict(images, imgsz=imgsz, conf=conf, device=device, verbose=False)
+    return [result_to_detections(r) for r in results]
+
+
+def run_batch_inference(inputs, weights=best_weights_path, out='detections.jsonl',
+                        render_dir=None, batch_size=16, imgsz=640, conf=0.25, device=None,
+                        workers=4, prefetch=64, sliced=False, cascade_config=None):
+    from ultralytics import YOLO
+
+    model = YOLO(weights)
+    cascade = None
+    if cascade_config:
+        from cascade import load_cascade
+
+        cascade = load_cascade(cascade_config, device)
+    names = model.names
+    if render_dir:
+        os.makedirs(render_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    n_images = n_detections = n_failed = 0
+
+    def decoded():
+        nonlocal n_failed
+        for path, image in prefetch_decode(iter_image_paths(inputs), workers, prefetch):
+            if image is None:
+                print(f'Could not read {path}')
+                n_failed += 1
+                continue
+            yield path, image
+
+    # Rendering and encoding run on their own threads
+    with open_writer(out) as writer, ThreadPoolExecutor(max_workers=2) as render_pool:
+        renders = deque()
+        for path, image, (boxes, classes, confidences) in predict_batches(
+            model, decoded(), batch_size, imgsz, conf, device, sliced, imgsz, cascade
+        ):
+            with span('inference.write'):
+                writer.write(
+                    detections_to_record(path, image.shape, boxes, classes, confidences, names)
+                )
+            n_images += 1
+            n_detections += len(boxes)
+
+            if render_dir:
+                dest = os.path.join(render_dir, os.path.basename(path))
+                renders.append(render_pool.submit(
+                    lambda d=dest, im=image, det=(boxes, classes, confidences):
+                        cv2.imwrite(d, draw_detections(im, *det, names))
+                ))
+                while len(renders) > prefetch:
+                    renders.popleft().result()
+        for future in renders:
+            future.result()
+
+    elapsed = time.perf_counter() - start
+    print(f'{n_images} images, {n_detections} detections, {n_failed} unreadable in '
+          f'{elapsed:.2f}s ({n_images / max(elapsed, 1e-9):.1f} images/sec)')
+    if cascade is not None:
+        print(f'Cascade skipped {cascade.skipped} of {cascade.screened} images')
+    return n_images
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch YOLO inference over image directories')
+    parser.add_argument('inputs', nargs='+', help='Image files, directories or .txt path lists')
+    parser.add_argument('--weights', default=str(best_weights_path))
+    parser.add_argument('--out', default='detections.jsonl', help='.jsonl or .parquet')
+    parser.add_argument('--render-dir', default=None, help='Write annotated images here')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--workers', type=int, default=4, help='Decode threads')
+    parser.add_argument('--prefetch', type=int, default=64, help='Images decoded ahead')
+    parser.add_argument('--sliced', action='store_true', help='Tiled inference per image')
+    parser.add_argument('--cascade', default=None,
+                        help='cascade.json; skip chips the empty-chip classifier rejects')
+    args = parser.parse_args()
+
+    run_batch_inference(
+        args.inputs, args.weights, args.out, args.render_dir, args.batch_size, args.imgsz,
+        args.conf, args.device, args.workers, args.prefetch, args.sliced, args.cascade,
+    )
+
+
+if __name__ == '__main__':
+    main()
+
+# %%
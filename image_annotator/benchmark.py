@@ -0,0 +1,264 @@
+# ------------------------------------------------------------------
+# Description: Benchmarks for the data and inference pipeline.
+# Generates synthetic LabelMe corpora (PNG chips with a varying number of
+# rectangles, including the misspelled labels existing_labels corrects),
+# then times LabelMe -> YOLO conversion, the dataset split and CPU YOLO
+# inference at several imgsz/batch settings. Results are written as JSON
+# with machine metadata and compared against a saved baseline.
+#
+# python benchmark.py --sizes 1000 10000 --out bench_results.json
+# python benchmark.py --sizes 1000 --baseline bench_baseline.json --threshold 0.15
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from prepare_annotations import classes, convert_labelme_to_yolo, existing_labels, split_dataset
+
+bench_dir = Path("bench_data")
+RESULTS_VERSION = 1
+
+
+def synthetic_sample(args):
+    # One chip and its LabelMe JSON, fully determined by (seed, i)
+    out_dir, i, seed, size, max_boxes = args
+    rng = random.Random(seed * 1_000_003 + i)
+    w, h = size
+    image = Image.new("RGB", size, tuple(rng.randrange(40, 120) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    labels = list(existing_labels)
+
+    shapes = []
+    # Skewed box counts: many sparse chips, a few dense yards
+    n_boxes = min(max_boxes, int(rng.expovariate(1 / max(max_boxes / 4, 1))))
+    for _ in range(n_boxes):
+        bw, bh = rng.randrange(8, w // 6), rng.randrange(8, h // 6)
+        x1, y1 = rng.randrange(0, w - bw), rng.randrange(0, h - bh)
+        draw.rectangle((x1, y1, x1 + bw, y1 + bh), fill=tuple(rng.randrange(256) for _ in range(3)))
+        if rng.random() < 0.1:
+            points = [[x1, y1], [x1 + bw, y1], [x1 + bw, y1 + bh], [x1, y1 + bh]]
+            shape_type = "polygon"
+        else:
+            points = [[x1, y1], [x1 + bw, y1 + bh]]
+            shape_type = "rectangle"
+        shapes.append({
+            "label": rng.choice(labels),
+            "points": points,
+            "group_id": None,
+            "shape_type": shape_type,
+            "flags": {},
+        })
+
+    stem = f"screenshot_{100000000 + i}"
+    image.save(os.path.join(out_dir, stem + ".png"), compress_level=1)
+    with open(os.path.join(out_dir, stem + ".json"), "w") as f:
+        json.dump({
+            "version": "5.5.0",
+            "flags": {},
+            "shapes": shapes,
+            "imagePath": stem + ".png",
+            "imageData": None,
+            "imageHeight": h,
+            "imageWidth": w,
+        }, f)
+    return n_boxes
+
+
+def make_corpus(n_files, out_dir=None, size=(1280, 1280), max_boxes=40, seed=0, workers=None):
+    # Reused between runs when it was generated with the same parameters
+    out_dir = Path(out_dir or bench_dir / f"labelme_{n_files}")
+    spec = {"n_files": n_files, "size": list(size), "max_boxes": max_boxes, "seed": seed}
+    spec_path = out_dir / "corpus.spec"
+    if spec_path.exists():
+        with open(spec_path, "r") as f:
+            if json.load(f) == spec:
+                return out_dir
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        n_boxes = sum(pool.map(
+            synthetic_sample,
+            [(str(out_dir), i, seed, size, max_boxes) for i in range(n_files)],
+            chunksize=32,
+        ))
+    with open(spec_path, "w") as f:
+        json.dump(spec, f)
+    print(f"Generated {n_files} synthetic chips ({n_boxes} boxes) in "
+          f"{time.perf_counter() - start:.1f}s under {out_dir}")
+    return out_dir
+
+
+def timed(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times), "repeats": repeats}
+
+
+def bench_convert(corpus, n_files, workers=None, repeats=3):
+    out_dir = corpus.parent / (corpus.name + "_yolo")
+
+    def run():
+        shutil.rmtree(out_dir, ignore_errors=True)
+        convert_labelme_to_yolo(corpus, out_dir, classes, workers=workers)
+
+    t = timed(run, repeats)
+    return dict(t, throughput=n_files / t["best"], unit="files/sec"), out_dir
+
+
+def bench_split(corpus, labels_dir, n_files, mode, repeats=3):
+    dest = corpus.parent / (corpus.name + f"_split_{mode}")
+    t = timed(lambda: split_dataset(corpus, labels_dir, dest, mode=mode, dedup=None), repeats)
+    return dict(t, throughput=n_files / t["best"], unit="files/sec")
+
+
+def bench_inference(images, weights, imgsz, batch_size, repeats=3):
+    from ultralytics import YOLO
+
+    model = YOLO(weights)
+    # Warm-up outside the timed region
+    model.predict(images[:batch_size], imgsz=imgsz, device="cpu", verbose=False)
+
+    def run():
+        for i in range(0, len(images), batch_size):
+            model.predict(images[i:i + batch_size], imgsz=imgsz, device="cpu", verbose=False)
+
+    t = timed(run, repeats)
+    return dict(t, throughput=len(images) / t["best"], unit="images/sec")
+
+
+def machine_metadata():
+    meta = {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+    }
+    try:
+        import cpuinfo
+
+        meta["cpu"] = cpuinfo.get_cpu_info().get("brand_raw")
+    except ImportError:
+        meta["cpu"] = platform.processor()
+    for module in ("torch", "ultralytics"):
+        try:
+            meta[module] = __import__(module).__version__
+        except ImportError:
+            pass
+    return meta
+
+
+def compare(results, baseline, threshold=0.1):
+    # A benchmark regresses when its throughput falls more than `threshold`
+    # below the baseline
+    regressions = []
+    print(f"{'benchmark':40s} {'baseline':>12s} {'current':>12s} {'change':>8s}")
+    for name, current in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:40s} {'-':>12s} {current['throughput']:12.1f}")
+            continue
+        change = current["throughput"] / base["throughput"] - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:40s} {base['throughput']:12.1f} {current['throughput']:12.1f} "
+              f"{change:+8.1%}{flag}")
+    if baseline.get("machine") != results["machine"]:
+        print("Note: baseline was recorded on a different machine or environment.")
+    return regressions
+
+
+def run_benchmarks(sizes, imgsz_list=(640, 1280), batch_sizes=(1, 8),
+                   split_modes=("hardlink", "copy", "manifest"), weights="yolov8n.pt",
+                   inference_images=32, workers=None, repeats=3, skip_inference=False):
+    results = {}
+    for n in sizes:
+        corpus = make_corpus(n, workers=workers)
+        results[f"convert/{n}"], labels_dir = bench_convert(corpus, n, workers, repeats)
+        for mode in split_modes:
+            results[f"split/{mode}/{n}"] = bench_split(corpus, labels_dir, n, mode, repeats)
+
+    if not skip_inference:
+        corpus = make_corpus(min(sizes), workers=workers)
+        images = [
+            np.asarray(Image.open(p).convert("RGB"))[:, :, ::-1]
+            for p in sorted(corpus.glob("*.png"))[:inference_images]
+        ]
+        for imgsz in imgsz_list:
+            for batch_size in batch_sizes:
+                results[f"inference/imgsz{imgsz}/batch{batch_size}"] = bench_inference(
+                    images, weights, imgsz, batch_size, repeats
+                )
+
+    for name, r in results.items():
+        print(f"{name:40s} {r['throughput']:10.1f} {r['unit']} (best {r['best']:.3f}s)")
+    return {
+        "version": RESULTS_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": machine_metadata(),
+        "config": {"sizes": list(sizes), "imgsz": list(imgsz_list),
+                   "batch_sizes": list(batch_sizes), "weights": str(weights),
+                   "inference_images": inference_images, "repeats": repeats},
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark conversion, split and inference")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000])
+    parser.add_argument("--imgsz", type=int, nargs="+", default=[640, 1280])
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--split-modes", nargs="+", default=["hardlink", "copy", "manifest"])
+    parser.add_argument("--weights", default="yolov8n.pt")
+    parser.add_argument("--inference-images", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--skip-inference", action="store_true")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--baseline", default=None, help="Compare against this results file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Allowed throughput drop before failing")
+    parser.add_argument("--save-baseline", default=None, help="Also write results here")
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        args.sizes, args.imgsz, args.batch, args.split_modes, args.weights,
+        args.inference_images, args.workers, args.repeats, args.skip_inference,
+    )
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        shutil.copyfile(args.out, args.save_baseline)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+# %%
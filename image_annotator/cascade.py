@@ -0,0 +1,257 @@
+# ------------------------------------------------------------------
+# Description: Two-stage cascade, a small classifier screens out chips
+# without assets before the detector runs.
+# The classifier (yolov8n-cls) is trained on the existing split in
+# dataset/: chips whose YOLO label file is empty are "empty", the rest
+# "assets". val is cut into two fixed halves by file name: the screening
+# threshold is tuned on the "tune" half for a target recall of asset chips
+# and stored in cascade.json next to the classifier path; the evaluation
+# runs on the "report" half and gives detector-only vs cascade throughput
+# and the share of chips and ground-truth boxes the screen throws away.
+#
+# python cascade.py build                       # dataset/ -> cascade_dataset/
+# python cascade.py train --epochs 20
+# python cascade.py tune --weights runs/classify/train/weights/best.pt --recall 0.99
+# python cascade.py evaluate
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+from batch_inference import batched, best_weights_path
+from yolo_paths import split_image_paths, yolo_label_path
+
+dataset_dir = Path("dataset")
+cascade_dir = Path("cascade_dataset")
+cascade_config = Path("cascade.json")
+POSITIVE, NEGATIVE = "assets", "empty"
+VAL_PARTS = ("tune", "report")
+
+
+def count_boxes(image_path):
+    try:
+        with open(yolo_label_path(image_path), "r") as f:
+            return sum(1 for line in f if line.strip())
+    except FileNotFoundError:
+        return 0
+
+
+def split_images(split, dataset_dir=dataset_dir):
+    # Directory or manifest split, see yolo_paths.split_image_paths
+    return split_image_paths(dataset_dir, split)
+
+
+def val_part(part, dataset_dir=dataset_dir):
+    # Half of val, fixed by crc32 of the file name so it does not depend on
+    # the listing order or on chips added later
+    index = VAL_PARTS.index(part)
+    return [p for p in split_images("val", dataset_dir)
+            if zlib.crc32(os.path.basename(p).encode()) % 2 == index]
+
+
+def build_cls_dataset(dataset_dir=dataset_dir, out_dir=cascade_dir, mode="hardlink"):
+    # prepare_annotations loads data.yml on import; only the build needs it
+    from prepare_annotations import materialize
+
+    # Ultralytics classification layout: <split>/<class>/<image>
+    counts = {}
+    tasks = []
+    for split in ("train", "val"):
+        for name in (POSITIVE, NEGATIVE):
+            # Chips from a previous build would leak between classes and splits
+            class_dir = Path(out_dir) / split / name
+            os.makedirs(class_dir, exist_ok=True)
+            for entry in os.scandir(class_dir):
+                if entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                    os.remove(entry.path)
+        for path in split_images(split, dataset_dir):
+            name = POSITIVE if count_boxes(path) else NEGATIVE
+            counts[(split, name)] = counts.get((split, name), 0) + 1
+            tasks.append((path, str(Path(out_dir) / split / name / os.path.basename(path)), mode))
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(lambda t: materialize(*t), tasks))
+    for split in ("train", "val"):
+        print(f"{split}: {counts.get((split, POSITIVE), 0)} {POSITIVE}, "
+              f"{counts.get((split, NEGATIVE), 0)} {NEGATIVE}")
+    return out_dir
+
+
+def train_classifier(data_dir=cascade_dir, model="yolov8n-cls.pt", imgsz=224, epochs=20,
+                     device=None):
+    from ultralytics import YOLO
+
+    classifier = YOLO(model)
+    classifier.train(data=str(data_dir), imgsz=imgsz, epochs=epochs, device=device)
+    return Path(classifier.trainer.best)
+
+
+class ChipScreen:
+    # P(chip has assets) from the classifier
+    def __init__(self, weights, imgsz=224, device=None):
+        from ultralytics import YOLO
+
+        self.model = YOLO(weights)
+        self.imgsz = imgsz
+        self.device = device
+        self.positive = {v: k for k, v in self.model.names.items()}[POSITIVE]
+
+    def scores(self, images):
+        results = self.model.predict(images, imgsz=self.imgsz, device=self.device, verbose=False)
+        return np.array([float(r.probs.data[self.positive]) for r in results])
+
+
+def tune_threshold(scores, has_assets, target_recall=0.99):
+    # Highest threshold that still keeps target_recall of the asset chips
+    positives = np.sort(scores[has_assets])
+    if positives.size == 0:
+        return 0.0
+    k = int(np.floor((1 - target_recall) * positives.size))
+    return float(positives[k])
+
+
+def save_config(weights, threshold, target_recall, imgsz, tuned_on, path=cascade_config):
+    with open(path, "w") as f:
+        json.dump({"classifier": str(weights), "threshold": threshold,
+                   "target_recall": target_recall, "imgsz": imgsz, "tuned_on": tuned_on},
+                  f, indent=2)
+
+
+def load_cascade(path=cascade_config, device=None):
+    with open(path, "r") as f:
+        config = json.load(f)
+    return Cascade(ChipScreen(config["classifier"], config["imgsz"], device),
+                   config["threshold"])
+
+
+class Cascade:
+    # Screens a batch and runs the detector only on the chips that pass
+    def __init__(self, screen, threshold):
+        self.screen = screen
+        self.threshold = threshold
+        self.screened = self.skipped = 0
+
+    def predict(self, images, detect):
+        # detect: list of images -> list of (boxes, classes, confidences)
+        keep = self.screen.scores(images) >= self.threshold
+        self.screened += len(images)
+        self.skipped += int((~keep).sum())
+        empty = (np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.float32))
+        detections = [empty] * len(images)
+        kept = [im for im, k in zip(images, keep) if k]
+        if kept:
+            for i, det in zip(np.flatnonzero(keep), detect(kept)):
+                detections[i] = det
+        return detections
+
+
+def load_images(paths):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        return list(pool.map(cv2.imread, paths))
+
+
+def evaluate(cascade, detector_weights=best_weights_path, dataset_dir=dataset_dir, batch_size=16,
+             imgsz=640, device=None):
+    from ultralytics import YOLO
+
+    detector = YOLO(detector_weights)
+    # Held out from tuning, so the missed figures are not fitted to it
+    paths = val_part("report", dataset_dir)
+    images = load_images(paths)
+    boxes = np.array([count_boxes(p) for p in paths])
+
+    # Warm both models outside the timed runs
+    detector.predict(images[:1], imgsz=imgsz, device=device, verbose=False)
+    cascade.screen.scores(images[:1])
+
+    start = time.perf_counter()
+    for batch in batched(images, batch_size):
+        detector.predict(batch, imgsz=imgsz, device=device, verbose=False)
+    detector_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores = []
+    for batch in batched(images, batch_size):
+        keep = cascade.screen.scores(batch)
+        scores.extend(keep)
+        kept = [im for im, s in zip(batch, keep) if s >= cascade.threshold]
+        if kept:
+            detector.predict(kept, imgsz=imgsz, device=device, verbose=False)
+    cascade_time = time.perf_counter() - start
+
+    skipped = np.array(scores) < cascade.threshold
+    n = len(paths)
+    report = {
+        "split": "val/report",
+        "images": n,
+        "detector_images_per_sec": n / detector_time,
+        "cascade_images_per_sec": n / cascade_time,
+        "speedup": detector_time / cascade_time,
+        "skipped_chips": float(skipped.mean()),
+        "missed_asset_chips": float((skipped & (boxes > 0)).sum() / max((boxes > 0).sum(), 1)),
+        "missed_boxes": float(boxes[skipped].sum() / max(boxes.sum(), 1)),
+        "threshold": cascade.threshold,
+    }
+    print(f"val/report: {n} chips, detector {report['detector_images_per_sec']:.1f} img/s, "
+          f"cascade {report['cascade_images_per_sec']:.1f} img/s ({report['speedup']:.2f}x), "
+          f"{report['skipped_chips']:.1%} skipped, {report['missed_asset_chips']:.1%} of asset "
+          f"chips and {report['missed_boxes']:.1%} of boxes missed")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Empty-chip cascade in front of the detector")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("build")
+    p.add_argument("--dataset", default=str(dataset_dir))
+    p.add_argument("--out", default=str(cascade_dir))
+    p = sub.add_parser("train")
+    p.add_argument("--data", default=str(cascade_dir))
+    p.add_argument("--model", default="yolov8n-cls.pt")
+    p.add_argument("--imgsz", type=int, default=224)
+    p.add_argument("--epochs", type=int, default=20)
+    p.add_argument("--device", default=None)
+    p = sub.add_parser("tune")
+    p.add_argument("--weights", required=True, help="Classifier weights")
+    p.add_argument("--recall", type=float, default=0.99, help="Asset chips to keep")
+    p.add_argument("--imgsz", type=int, default=224)
+    p.add_argument("--dataset", default=str(dataset_dir))
+    p.add_argument("--device", default=None)
+    p = sub.add_parser("evaluate")
+    p.add_argument("--config", default=str(cascade_config))
+    p.add_argument("--detector", default=str(best_weights_path))
+    p.add_argument("--dataset", default=str(dataset_dir))
+    p.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_cls_dataset(args.dataset, args.out)
+    elif args.command == "train":
+        weights = train_classifier(args.data, args.model, args.imgsz, args.epochs, args.device)
+        print(f"Classifier weights: {weights}")
+    elif args.command == "tune":
+        screen = ChipScreen(args.weights, args.imgsz, args.device)
+        paths = val_part("tune", args.dataset)
+        scores = np.concatenate([screen.scores(load_images(b)) for b in batched(paths, 64)])
+        has_assets = np.array([count_boxes(p) > 0 for p in paths])
+        threshold = tune_threshold(scores, has_assets, args.recall)
+        save_config(args.weights, threshold, args.recall, args.imgsz, "val/tune")
+        print(f"Threshold {threshold:.4f} keeps {args.recall:.1%} of asset chips, "
+              f"skips {(scores < threshold).mean():.1%} of {len(paths)} val/tune chips; "
+              f"saved to {cascade_config}")
+    else:
+        evaluate(load_cascade(args.config, args.device), args.detector, args.dataset,
+                 device=args.device)
+
+
+if __name__ == "__main__":
+    main()
+
+# %%
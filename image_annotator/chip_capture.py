@@ -0,0 +1,284 @@
+# ------------------------------------------------------------------
+# Description: Headless bulk chip capture over the substation table.
+# Every substation is rendered off-screen at a fixed zoom and footprint by
+# several QWebEngine pages at once and written as a 1280x1280 chip plus a
+# JSON sidecar (center lat/lon, zoom, heading and the crop/scale/pad
+# transform). Chips that already have a sidecar are skipped, so an
+# interrupted run picks up where it stopped.
+#
+# python chip_capture.py --out chips --concurrency 4
+# python chip_capture.py --tile-url "http://localhost:8000/{z}/{x}/{y}.png"
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+import argparse
+import math
+import os
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QRect, QTimer, QUrl
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtWebEngineWidgets import QWebEngineView
+
+from pyqtee import CaptureJob, api_key, capture_metadata, encode_options, write_sidecar
+from tile_cache import TILE_SIZE, lat_lon_to_tile
+
+chips_dir = Path("chips")
+CHIP_SIZE = (1280, 1280)
+
+
+def google_maps_html(lat, lon, zoom, heading, api_key, token="ready"):
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <script src="https://maps.googleapis.com/maps/api/js?key={api_key}"></script>
+        <style>html, body, #map {{ height: 100%; width: 100%; margin: 0; padding: 0; }}</style>
+    </head>
+    <body>
+        <div id="map"></div>
+        <script>
+            const map = new google.maps.Map(document.getElementById("map"), {{
+                center: {{ lat: {lat}, lng: {lon} }},
+                zoom: {zoom},
+                heading: {heading},
+                tilt: 0,
+                mapId: "90f87356969d889c",
+                mapTypeId: "satellite",
+                disableDefaultUI: true,
+            }});
+            google.maps.event.addListenerOnce(map, "tilesloaded", () => {{
+                document.title = "{token}";
+            }});
+        </script>
+    </body>
+    </html>
+    """
+
+
+def tile_grid_html(lat, lon, zoom, heading, tile_url, width, height, token="ready"):
+    # Plain <img> mosaic of XYZ tiles around the center, no map library
+    cx, cy = lat_lon_to_tile(lat, lon, zoom)
+    n = 2**zoom
+    # Rotated views need the corners of the viewport covered as well
+    radius = math.hypot(width, height) / 2 / TILE_SIZE + 1
+    imgs = []
+    for ty in range(int(cy - radius), int(cy + radius) + 1):
+        if not 0 <= ty < n:
+            continue
+        for tx in range(int(cx - radius), int(cx + radius) + 1):
+            left = width / 2 + (tx - cx) * TILE_SIZE
+            top = height / 2 + (ty - cy) * TILE_SIZE
+            src = tile_url.format(z=zoom, x=tx % n, y=ty)
+            imgs.append(
+                f'<img src="{src}" style="position:absolute;left:{left:.2f}px;'
+                f'top:{top:.2f}px;width:{TILE_SIZE}px;height:{TILE_SIZE}px">'
+            )
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <style>html, body {{ margin: 0; padding: 0; overflow: hidden; background: black; }}</style>
+    </head>
+    <body>
+        <div id="tiles" style="position:absolute;width:{width}px;height:{height}px;
+             transform:rotate({-heading}deg);transform-origin:50% 50%">
+            {"".join(imgs)}
+        </div>
+        <script>
+            const imgs = Array.from(document.images);
+            let pending = imgs.length;
+            const done = () => {{ if (--pending <= 0) document.title = "{token}"; }};
+            imgs.forEach(img => {{
+                if (img.complete) done();
+                else {{ img.onload = done; img.onerror = done; }}
+            }});
+            if (imgs.length === 0) document.title = "{token}";
+        </script>
+    </body>
+    </html>
+    """
+
+
+class ChipWorker:
+    def __init__(self, runner, footprint):
+        self.runner = runner
+        self.view = QWebEngineView()
+        self.view.resize(footprint, footprint)
+        self.view.show()
+        self.view.titleChanged.connect(self.on_title)
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.on_timeout)
+        self.job = None
+
+    def start(self, job):
+        self.job = job
+        self.job["started"] = time.perf_counter()
+        self.view.setHtml(self.runner.page_html(job), QUrl(""))
+        self.timer.start(int(self.runner.timeout * 1000))
+
+    def on_title(self, title):
+        # Each page sets its own token, so consecutive jobs always change the title
+        if self.job is not None and title == self.runner.ready_token(self.job):
+            self.timer.stop()
+            # Give the compositor a moment to paint the last tiles
+            QTimer.singleShot(self.runner.settle_ms, self.capture)
+
+    def capture(self):
+        if self.job is None:
+            return
+        job, self.job = self.job, None
+        image = self.view.grab().toImage()
+        self.runner.save(job, image)
+        self.runner.next(self)
+
+    def on_timeout(self):
+        if self.job is None:
+            return
+        job, self.job = self.job, None
+        self.runner.failed(job, "timed out waiting for tiles")
+        self.runner.next(self)
+
+
+class ChipCaptureRunner:
+    def __init__(self, substations, out_dir=chips_dir, zoom=18, heading=0, footprint=1280,
+                 concurrency=4, tile_url=None, timeout=30, settle_ms=300, retries=1):
+        self.out_dir = Path(out_dir)
+        self.zoom = zoom
+        self.heading = heading
+        self.footprint = footprint
+        self.tile_url = tile_url
+        self.timeout = timeout
+        self.settle_ms = settle_ms
+        self.retries = retries
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        self.queue = [
+            {"ss_id": int(row.SS_ID), "ss_type": str(row.SS_TYPE),
+             "lat": float(row.lat), "lon": float(row.lon), "attempts": 0}
+            for row in substations.itertuples()
+            if not self.sidecar_path(int(row.SS_ID)).exists()
+        ]
+        self.skipped = len(substations) - len(self.queue)
+        self.total = len(self.queue)
+        self.done = self.n_failed = self.in_flight = 0
+        self.start_time = time.perf_counter()
+        self.workers = [ChipWorker(self, footprint) for _ in range(concurrency)]
+
+    def chip_stem(self, ss_id):
+        return self.out_dir / f"screenshot_{ss_id}"
+
+    def sidecar_path(self, ss_id):
+        # Same name pyqtee.sidecar_path gives the chip
+        return self.out_dir / f"screenshot_{ss_id}.meta.json"
+
+    def ready_token(self, job):
+        return f"ready-{job['ss_id']}-{job['attempts']}"
+
+    def page_html(self, job):
+        token = self.ready_token(job)
+        if self.tile_url:
+            return tile_grid_html(job["lat"], job["lon"], self.zoom, self.heading,
+                                  self.tile_url, self.footprint, self.footprint, token)
+        return google_maps_html(job["lat"], job["lon"], self.zoom, self.heading, api_key, token)
+
+    def run(self):
+        if not self.queue:
+            print(f"Nothing to capture, {self.skipped} substations already done.")
+            return
+        print(f"Capturing {self.total} chips ({self.skipped} already done) "
+              f"with {len(self.workers)} pages")
+        for worker in self.workers:
+            self.next(worker)
+
+    def next(self, worker):
+        if self.queue:
+            self.in_flight += 1
+            worker.start(self.queue.pop(0))
+        if self.in_flight == 0 and not self.queue:
+            elapsed = time.perf_counter() - self.start_time
+            print(f"Captured {self.done} chips, {self.n_failed} failed in {elapsed:.0f}s "
+                  f"({self.done / max(elapsed, 1e-9):.2f} chips/sec)")
+            QApplication.instance().quit()
+
+    def save(self, job, image):
+        self.in_flight -= 1
+        capture = CaptureJob(
+            image, QRect(0, 0, image.width(), image.height()),
+            str(self.chip_stem(job["ss_id"])), CHIP_SIZE,
+        )
+        # Encoding runs inline here; the web pages render in parallel
+        capture.signals.finished.connect(lambda path, timings: self.write_sidecar(job, path, image))
+        capture.signals.failed.connect(lambda e: self.failed(job, e, in_flight=False))
+        capture.run()
+
+    def write_sidecar(self, job, path, image):
+        sidecar = capture_metadata(
+            job["lat"], job["lon"], self.zoom, self.heading, 0, image,
+            QRect(0, 0, image.width(), image.height()), CHIP_SIZE,
+        )
+        sidecar.update(ss_id=job["ss_id"], ss_type=job["ss_type"], image=os.path.basename(path),
+                       tile_source=self.tile_url or "google-maps-js")
+        # The sidecar marks a chip as done, so it is written last
+        write_sidecar(path, sidecar)
+
+        self.done += 1
+        if self.done % 50 == 0:
+            elapsed = time.perf_counter() - self.start_time
+            print(f"{self.done}/{self.total} chips ({self.done / elapsed:.2f} chips/sec)")
+
+    def failed(self, job, reason, in_flight=True):
+        if in_flight:
+            self.in_flight -= 1
+        job["attempts"] += 1
+        if job["attempts"] <= self.retries:
+            self.queue.append(job)
+        else:
+            self.n_failed += 1
+            print(f"Substation {job['ss_id']} failed: {reason}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless bulk chip capture")
+    parser.add_argument("--out", default=str(chips_dir))
+    parser.add_argument("--ss-type", default=None, help="Only this SS_TYPE")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--zoom", type=int, default=18)
+    parser.add_argument("--heading", type=float, default=0)
+    parser.add_argument("--footprint", type=int, default=1280, help="Viewport size in px")
+    parser.add_argument("--concurrency", type=int, default=4, help="Off-screen pages")
+    parser.add_argument("--tile-url", default=os.getenv("tile_url"),
+                        help="XYZ {z}/{x}/{y} template instead of Google Maps")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--retries", type=int, default=1)
+    args = parser.parse_args()
+
+    from geodata_cache import load_cached, prepare_substations, substations_path
+
+    substations = load_cached(substations_path, prepare_substations)
+    if args.ss_type:
+        substations = substations[substations["SS_TYPE"] == args.ss_type]
+    if args.limit:
+        substations = substations.iloc[: args.limit]
+
+    ext, _, _ = encode_options()
+    print(f"Writing {ext} chips to {args.out}")
+
+    app = QApplication(sys.argv)
+    runner = ChipCaptureRunner(
+        substations, args.out, args.zoom, args.heading, args.footprint, args.concurrency,
+        args.tile_url, args.timeout, retries=args.retries,
+    )
+    QTimer.singleShot(0, runner.run)
+    if runner.queue:
+        app.exec_()
+
+
+if __name__ == "__main__":
+    main()
+
+# %%
@@ -0,0 +1,234 @@
+# ------------------------------------------------------------------
+# Description: Near-duplicate detection for the captured chips.
+# 64-bit perceptual hashes (dHash or DCT pHash) are computed on a process
+# pool and cached by file size/mtime. Candidate pairs come from a
+# multi-index lookup: with the hash cut into threshold + 1 chunks, two
+# hashes within `threshold` bits agree exactly on at least one chunk, so
+# only images sharing a chunk value are compared. Pairs are merged into
+# clusters with union-find; split_dataset keeps each cluster in one split
+# or drops all but one image per cluster.
+#
+# python dedup.py Annotations --threshold 4
+# ------------------------------------------------------------------
+# %%
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+hash_methods = ('dhash', 'phash')
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash(path, hash_size=8):
+    # Sign of the horizontal gradient on a 9x8 thumbnail
+    with Image.open(path) as im:
+        pixels = np.asarray(im.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR),
+                            dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def phash(path, hash_size=8, highfreq_factor=4):
+    from scipy.fft import dctn
+
+    size = hash_size * highfreq_factor
+    with Image.open(path) as im:
+        pixels = np.asarray(im.convert('L').resize((size, size), Image.LANCZOS), dtype=np.float32)
+    low = dctn(pixels, norm='ortho')[:hash_size, :hash_size]
+    # Median without the DC term, which only carries mean brightness
+    bits = (low > np.median(low.ravel()[1:])).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hash_file(args):
+    path, method = args
+    try:
+        return dhash(path) if method == 'dhash' else phash(path)
+    except OSError:
+        return None
+
+
+def compute_hashes(paths, method='dhash', workers=None, cache_path=None, chunksize=64):
+    if method not in hash_methods:
+        raise ValueError(f'Unknown hash method: {method}, expected one of {hash_methods}')
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        if cache.get('method') != method:
+            cache = {}
+    entries = cache.get('files', {})
+
+    hashes = {}
+    todo = []
+    for path in paths:
+        st = os.stat(path)
+        key = str(path)
+        entry = entries.get(key)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            hashes[key] = int(entry[2], 16)
+        else:
+            todo.append((key, st))
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(hash_file, [(key, method) for key, _ in todo], chunksize=chunksize)
+            for (key, st), h in zip(todo, results):
+                if h is None:
+                    print(f'Could not hash {key}')
+                    continue
+                hashes[key] = h
+                entries[key] = [st.st_size, st.st_mtime_ns, f'{h:016x}']
+
+    if cache_path and todo:
+        with open(f'{cache_path}.tmp', 'w') as f:
+            json.dump({'method': method, 'files': entries}, f)
+        os.replace(f'{cache_path}.tmp', cache_path)
+    return hashes, len(todo)
+
+
+def hamming(a, b):
+    # Bit distance between (broadcast) uint64 arrays
+    x = np.bitwise_xor(a, b)
+    return POPCOUNT[x.view(np.uint8)].reshape(*x.shape, 8).sum(axis=-1)
+
+
+def bucket_pairs(values, bucket, threshold, max_cells=1 << 20):
+    # Pairs within `threshold` bits inside one bucket, compared in row blocks
+    # of at most max_cells comparisons so one huge bucket stays bounded in memory
+    m = len(bucket)
+    h = values[bucket]
+    step = max(1, max_cells // m)
+    for a in range(0, m - 1, step):
+        b = min(a + step, m - 1)
+        i, j = np.nonzero(hamming(h[a:b, None], h[None, a + 1:]) <= threshold)
+        i, j = i + a, j + a + 1
+        upper = j > i
+        yield bucket[i[upper]], bucket[j[upper]]
+
+
+def near_duplicate_pairs(hashes, threshold=4):
+    # hashes: uint64 array. Returns (i, j) index pairs within `threshold` bits,
+    # enough of them to connect every cluster: images with identical hashes
+    # (e.g. many near-black chips) are chained to their first occurrence and
+    # only the distinct values are compared
+    values, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    rep = first[inverse.ravel()]
+    idx = np.arange(len(hashes))
+    same = rep != idx
+    pairs = set(zip(rep[same].tolist(), idx[same].tolist()))
+
+    n_chunks = threshold + 1
+    bounds = np.linspace(0, 64, n_chunks + 1).astype(int)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        mask = np.uint64((1 << (hi - lo)) - 1)
+        keys = (values >> np.uint64(lo)) & mask
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        for s, e in zip(starts, ends):
+            if e - s < 2:
+                continue
+            for i, j in bucket_pairs(values, order[s:e], threshold):
+                a, b = first[i], first[j]
+                pairs.update(zip(np.minimum(a, b).tolist(), np.maximum(a, b).tolist()))
+    return pairs
+
+
+def cluster(n, pairs):
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    return np.array([find(i) for i in range(n)])
+
+
+def find_duplicates(image_dir, image_files, threshold=4, method='dhash', workers=None,
+                    cache_path=None):
+    # Cluster id per image file (the index of its first member)
+    if not image_files:
+        return {}
+    start = time.perf_counter()
+    paths = [os.path.join(image_dir, f) for f in image_files]
+    hashes, n_hashed = compute_hashes(paths, method, workers, cache_path)
+    hashed = [i for i, p in enumerate(paths) if p in hashes]
+    values = np.array([hashes[paths[i]] for i in hashed], dtype=np.uint64)
+    labels = cluster(len(hashed), near_duplicate_pairs(values, threshold))
+
+    groups = {f: i for i, f in enumerate(image_files)}
+    for k, i in enumerate(hashed):
+        groups[image_files[i]] = hashed[labels[k]]
+
+    n_groups = len(set(groups.values()))
+    sizes = np.bincount(list(groups.values()))
+    print(f'Dedup ({method}, <= {threshold} bits): {len(image_files)} images in {n_groups} '
+          f'clusters, {int((sizes > 1).sum())} with near-duplicates, largest {sizes.max()} '
+          f'({n_hashed} hashed, {time.perf_counter() - start:.2f}s)')
+    return groups
+
+
+def count_labels(label_file):
+    try:
+        with open(label_file, 'r') as f:
+            return sum(1 for line in f if line.strip())
+    except FileNotFoundError:
+        return 0
+
+
+def keep_one_per_group(image_files, groups, labels_dir):
+    # The image with most boxes represents its cluster
+    best = {}
+    for f in sorted(image_files):
+        n = count_labels(os.path.join(labels_dir, os.path.splitext(f)[0] + '.txt'))
+        g = groups[f]
+        if g not in best or n > best[g][0]:
+            best[g] = (n, f)
+    keep = sorted(f for _, f in best.values())
+    dropped = len(image_files) - len(keep)
+    print(f'Dropping {dropped} near-duplicates, {len(image_files)} -> {len(keep)} images '
+          f'({dropped / max(len(image_files), 1):.1%} smaller)')
+    return keep
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find near-duplicate chips')
+    parser.add_argument('image_dir')
+    parser.add_argument('--threshold', type=int, default=4, help='Max differing hash bits')
+    parser.add_argument('--method', default='dhash', choices=hash_methods)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache', default=None, help='JSON hash cache')
+    parser.add_argument('--out', default=None, help='Write clusters with >1 image as JSON')
+    args = parser.parse_args()
+
+    image_files = sorted(f for f in os.listdir(args.image_dir)
+                         if f.endswith(('.jpg', '.jpeg', '.png', '.webp')))
+    groups = find_duplicates(args.image_dir, image_files, args.threshold, args.method,
+                             args.workers, args.cache)
+    clusters = {}
+    for f, g in groups.items():
+        clusters.setdefault(g, []).append(f)
+    clusters = [members for members in clusters.values() if len(members) > 1]
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(clusters, f, indent=1)
+    print(f'{sum(len(c) - 1 for c in clusters)} images are near-duplicates of another')
+
+
+if __name__ == '__main__':
+    main()
+
+# %%
@@ -0,0 +1,233 @@
+# ------------------------------------------------------------------
+# Description: CPU deployment path for the trained detector.
+# Exports best.pt to ONNX, optionally quantizes it to static INT8 with
+# calibration images from dataset/images/val, and compares the exported
+# models against PyTorch: mAP, box agreement, latency and throughput.
+# Ultralytics loads .onnx weights through onnxruntime, so the exported
+# models are used with the same YOLO(...) results interface.
+#
+# python export_onnx.py --weights best.pt --int8 --report parity.json
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from batch_inference import best_weights_path, iter_image_paths, result_to_detections
+from sliced_inference import box_iou
+
+calibration_dir = Path('dataset/images/val')
+data_path = Path(__file__).resolve().parent / 'data.yml'
+
+
+def export_onnx(weights=best_weights_path, imgsz=640, dynamic=False, opset=None):
+    from ultralytics import YOLO
+
+    model = YOLO(weights)
+    return model.export(format='onnx', imgsz=imgsz, dynamic=dynamic, simplify=True,
+                        opset=opset, device='cpu')
+
+
+def letterbox(image, imgsz=640, color=114):
+    # Same preprocessing as Ultralytics: resize the long side, pad to square
+    h, w = image.shape[:2]
+    r = imgsz / max(h, w)
+    nw, nh = int(round(w * r)), int(round(h * r))
+    resized = cv2.resize(image, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    out = np.full((imgsz, imgsz, 3), color, dtype=np.uint8)
+    top, left = (imgsz - nh) // 2, (imgsz - nw) // 2
+    out[top:top + nh, left:left + nw] = resized
+    return out
+
+
+def preprocess(image, imgsz=640):
+    x = letterbox(image, imgsz)[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, HWC to CHW
+    return np.ascontiguousarray(x[None], dtype=np.float32) / 255
+
+
+class ValCalibrationReader:
+    # Feeds our own val images to the INT8 calibrator
+    def __init__(self, input_name, image_dir=calibration_dir, imgsz=640, limit=200):
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self.paths = list(iter_image_paths([image_dir]))[:limit]
+        self.iter = iter(self.paths)
+
+    def get_next(self):
+        for path in self.iter:
+            image = cv2.imread(path)
+            if image is not None:
+                return {self.input_name: preprocess(image, self.imgsz)}
+        return None
+
+    def rewind(self):
+        self.iter = iter(self.paths)
+
+
+def head_nodes(onnx_model, weights):
+    # Keep the Detect head (box decoding and concat) in float; quantizing
+    # it collapses box coordinates and class scores into one scale.
+    from ultralytics import YOLO
+
+    head_index = len(YOLO(weights).model.model) - 1
+    prefix = f'/model.{head_index}/'
+    return [
+        n.name for n in onnx_model.graph.node
+        if n.name.startswith(prefix) and not n.op_type.startswith('Conv')
+    ]
+
+
+def quantize_int8(onnx_path, weights=best_weights_path, image_dir=calibration_dir, imgsz=640,
+                  limit=200, output_path=None):
+    import onnx
+    from onnxruntime.quantization import (
+        CalibrationMethod, QuantFormat, QuantType, quantize_static,
+    )
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    onnx_path = Path(onnx_path)
+    output_path = output_path or onnx_path.with_name(onnx_path.stem + '_int8.onnx')
+    prep_path = onnx_path.with_name(onnx_path.stem + '_prep.onnx')
+    quant_pre_process(str(onnx_path), str(prep_path))
+
+    model = onnx.load(str(prep_path))
+    reader = ValCalibrationReader(model.graph.input[0].name, image_dir, imgsz, limit)
+    if not reader.paths:
+        raise FileNotFoundError(f'No calibration images in {image_dir}')
+
+    quantize_static(
+        str(prep_path), str(output_path), reader,
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+        calibrate_method=CalibrationMethod.MinMax,
+        nodes_to_exclude=head_nodes(model, weights),
+    )
+    os.remove(prep_path)
+    print(f'INT8 model calibrated on {len(reader.paths)} images: {output_path}')
+    return output_path
+
+
+def match_boxes(a, b, iou_threshold=0.5):
+    # Greedy same-class matching of two detection sets
+    boxes_a, cls_a, conf_a = a
+    boxes_b, cls_b, conf_b = b
+    used = np.zeros(len(boxes_b), dtype=bool)
+    ious, conf_diffs = [], []
+    for i in np.argsort(-conf_a):
+        candidates = np.flatnonzero((cls_b == cls_a[i]) & ~used)
+        if candidates.size == 0:
+            continue
+        iou = box_iou(boxes_a[i], boxes_b[candidates])
+        j = iou.argmax()
+        if iou[j] >= iou_threshold:
+            used[candidates[j]] = True
+            ious.append(iou[j])
+            conf_diffs.append(abs(conf_a[i] - conf_b[candidates[j]]))
+    return ious, conf_diffs
+
+
+def benchmark(model, images, imgsz=640, warmup=3):
+    for image in images[:warmup]:
+        model.predict(image, imgsz=imgsz, device='cpu', verbose=False)
+    detections, latencies = [], []
+    start = time.perf_counter()
+    for image in images:
+        t = time.perf_counter()
+        result = model.predict(image, imgsz=imgsz, device='cpu', verbose=False)[0]
+        latencies.append(time.perf_counter() - t)
+        detections.append(result_to_detections(result))
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    timing = {
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        'images_per_sec': len(images) / elapsed,
+    }
+    return detections, timing
+
+
+def parity_report(weights=best_weights_path, exported=(), image_dir=calibration_dir,
+                  data=data_path, imgsz=640, limit=200, run_val=True):
+    from ultralytics import YOLO
+
+    paths = list(iter_image_paths([image_dir]))[:limit]
+    images = [image for image in map(cv2.imread, paths) if image is not None]
+
+    reference = YOLO(weights)
+    ref_detections, ref_timing = benchmark(reference, images, imgsz)
+    report = {'images': len(images), 'imgsz': imgsz,
+              'models': {str(weights): {'timing': ref_timing}}}
+    if run_val:
+        metrics = reference.val(data=str(data), imgsz=imgsz, device='cpu', verbose=False)
+        report['models'][str(weights)].update(map50=metrics.box.map50, map=metrics.box.map)
+
+    for path in exported:
+        model = YOLO(path, task='detect')
+        detections, timing = benchmark(model, images, imgsz)
+
+        n_ref = sum(len(d[0]) for d in ref_detections)
+        n_new = sum(len(d[0]) for d in detections)
+        ious, conf_diffs = [], []
+        for ref, new in zip(ref_detections, detections):
+            i, c = match_boxes(ref, new)
+            ious.extend(i)
+            conf_diffs.extend(c)
+
+        entry = {
+            'timing': timing,
+            'speedup': timing['images_per_sec'] / ref_timing['images_per_sec'],
+            'boxes': n_new,
+            'reference_boxes': n_ref,
+            # Matched boxes over the larger of the two box sets
+            'box_agreement': len(ious) / max(n_ref, n_new, 1),
+            'mean_iou': float(np.mean(ious)) if ious else None,
+            'mean_conf_diff': float(np.mean(conf_diffs)) if conf_diffs else None,
+        }
+        if run_val:
+            metrics = model.val(data=str(data), imgsz=imgsz, batch=1, device='cpu', verbose=False)
+            entry.update(map50=metrics.box.map50, map=metrics.box.map)
+        report['models'][str(path)] = entry
+
+    for name, entry in report['models'].items():
+        print(f"{os.path.basename(name)}: {entry['timing']['images_per_sec']:.1f} img/s, "
+              f"p50 {entry['timing']['latency_ms_p50']:.1f} ms"
+              + (f", mAP50-95 {entry['map']:.3f}" if 'map' in entry else '')
+              + (f", box agreement {entry['box_agreement']:.1%}" if 'box_agreement' in entry else ''))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export best.pt to ONNX/INT8 and check parity')
+    parser.add_argument('--weights', default=str(best_weights_path))
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--int8', action='store_true', help='Also write a static INT8 model')
+    parser.add_argument('--calibration-dir', default=str(calibration_dir))
+    parser.add_argument('--calibration-images', type=int, default=200)
+    parser.add_argument('--data', default=str(data_path))
+    parser.add_argument('--no-val', action='store_true', help='Skip the mAP comparison')
+    parser.add_argument('--report', default='parity_report.json')
+    args = parser.parse_args()
+
+    exported = [export_onnx(args.weights, args.imgsz)]
+    if args.int8:
+        exported.append(quantize_int8(exported[0], args.weights, args.calibration_dir,
+                                      args.imgsz, args.calibration_images))
+
+    report = parity_report(args.weights, exported, args.calibration_dir, args.data,
+                           args.imgsz, run_val=not args.no_val)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2, default=float)
+    print(f'Parity report saved to {args.report}')
+
+
+if __name__ == '__main__':
+    main()
+
+# %%
@@ -0,0 +1,101 @@
+# ------------------------------------------------------------------
+# Description: Binary snapshot cache for the substation and transmission
+# line GeoJSON. The reprojected frames are stored as GeoParquet with only
+# the columns the viewer uses and compact dtypes (int32 IDs, categorical
+# SS_TYPE, float32 lat/lon). A snapshot is rebuilt when its source
+# GeoJSON changes (mtime or size).
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+import json
+import os
+import time
+
+import numpy as np
+import geopandas as gpd
+
+substations_path = Path("substations_filtered.geojson")
+lines_path = Path("split_lines_filtered.geojson")
+cache_dir = Path("geodata_cache")
+
+CACHE_VERSION = 1
+
+
+def compact_int(series):
+    # int32 when the IDs allow it, otherwise leave the column as read
+    if series.isna().any():
+        return series
+    values = series.to_numpy()
+    if np.issubdtype(values.dtype, np.number) and (
+        values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max
+    ):
+        return series.astype(np.int32)
+    return series
+
+
+def prepare_substations(path):
+    gdf = gpd.read_file(path)
+    gdf["SS_ID"] = gdf["substation"]
+
+    # Make sure the CRS is set to EPSG:4326
+    gdf = gdf.to_crs(epsg=4326)
+
+    # Create lat and lon from geom points
+    gdf["lat"] = gdf.geometry.y.astype(np.float32)
+    gdf["lon"] = gdf.geometry.x.astype(np.float32)
+
+    gdf = gdf[["SS_ID", "SS_TYPE", "lat", "lon", "geometry"]]
+    gdf["SS_ID"] = compact_int(gdf["SS_ID"])
+    gdf["SS_TYPE"] = gdf["SS_TYPE"].astype("category")
+    return gdf
+
+
+def prepare_lines(path):
+    gdf = gpd.read_file(path)
+
+    # Make sure crs is set to EPSG:4326
+    gdf = gdf.to_crs(epsg=4326)
+
+    gdf = gdf[["substation_a", "substation_b", "geometry"]]
+    for col in ("substation_a", "substation_b"):
+        gdf[col] = compact_int(gdf[col])
+    return gdf
+
+
+def source_signature(path):
+    st = os.stat(path)
+    return {"version": CACHE_VERSION, "mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def load_cached(source, prepare, cache_dir=cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    name = Path(source).stem
+    snapshot = os.path.join(cache_dir, f"{name}.parquet")
+    meta_path = os.path.join(cache_dir, f"{name}.meta.json")
+    signature = source_signature(source)
+
+    try:
+        with open(meta_path, "r") as f:
+            if json.load(f) == signature:
+                return gpd.read_parquet(snapshot)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    start = time.perf_counter()
+    gdf = prepare(source)
+    gdf.to_parquet(snapshot + ".tmp")
+    os.replace(snapshot + ".tmp", snapshot)
+    # The signature is written last so a half-written snapshot is never used
+    with open(meta_path, "w") as f:
+        json.dump(signature, f)
+    print(f"Rebuilt {snapshot} from {source} in {time.perf_counter() - start:.1f}s")
+    return gdf
+
+
+def load_geodata(substations=substations_path, lines=lines_path, cache_dir=cache_dir):
+    return (
+        load_cached(substations, prepare_substations, cache_dir),
+        load_cached(lines, prepare_lines, cache_dir),
+    )
+
+# %%
@@ -0,0 +1,299 @@
+# ------------------------------------------------------------------
+# Description: Project-level cache of decoded, resized training images.
+# Each image is decoded and resized once per imgsz exactly as Ultralytics'
+# load_image does (long side to imgsz, INTER_LINEAR) and stored as a .npy
+# under image_cache/<imgsz>/ keyed by the sha1 of the file contents, so
+# hardlinked copies in dataset/ and re-splits hit the same entry. Entries
+# are memory-mapped read-only and shared by concurrent and successive
+# runs; the page cache does the rest. CachedDetectionTrainer plugs the
+# cache into model.train().
+#
+# python image_cache.py dataset/images --imgsz 640          # warm the cache
+# python image_cache.py dataset/images --imgsz 640 --bench  # load-time comparison
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import json
+import math
+import os
+import struct
+import time
+
+import cv2
+import numpy as np
+
+cache_dir = Path("image_cache")
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def resize_like_ultralytics(im, imgsz):
+    # BaseDataset.load_image with rect_mode=True
+    h0, w0 = im.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r != 1:
+        w, h = min(math.ceil(w0 * r), imgsz), min(math.ceil(h0 * r), imgsz)
+        im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+    return im
+
+
+def decode_resized(data, imgsz):
+    im = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if im is None:
+        raise ValueError('Could not decode image')
+    return resize_like_ultralytics(im, imgsz), im.shape[:2]
+
+
+def original_size(data):
+    # (h, w) from the PNG header, or None if it has to be decoded
+    if data[:8] == PNG_SIGNATURE and data[12:16] == b'IHDR':
+        w, h = struct.unpack('>II', data[16:24])
+        return h, w
+    return None
+
+
+class ImageCache:
+    def __init__(self, imgsz=640, cache_dir=cache_dir):
+        self.imgsz = imgsz
+        self.root = Path(cache_dir)
+        self.dir = self.root / str(imgsz)
+        self.index_path = self.root / 'paths.json'
+        # path -> [size, mtime_ns, sha1, h0, w0], so unchanged files are not re-hashed
+        self.index = {}
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.index = json.load(f)
+            except json.JSONDecodeError:
+                pass
+        self.hits = self.misses = 0
+
+    def entry_path(self, digest):
+        return self.dir / digest[:2] / f'{digest}.npy'
+
+    def lookup(self, path):
+        st = os.stat(path)
+        entry = self.index.get(str(path))
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2], (entry[3], entry[4]), None
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        hw0 = original_size(data)
+        if hw0 is not None:
+            self.index[str(path)] = [st.st_size, st.st_mtime_ns, digest, *hw0]
+        return digest, hw0, data
+
+    def get(self, path):
+        # (read-only memory-mapped image, original (h, w))
+        digest, hw0, data = self.lookup(path)
+        entry = self.entry_path(digest)
+        if hw0 is not None:
+            try:
+                im = np.load(entry, mmap_mode='r')
+                self.hits += 1
+                return im, hw0
+            except (FileNotFoundError, ValueError):
+                pass
+        self.misses += 1
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        im, hw0 = decode_resized(data, self.imgsz)
+        st = os.stat(path)
+        self.index[str(path)] = [st.st_size, st.st_mtime_ns, digest, *hw0]
+        self.store(entry, im)
+        return np.load(entry, mmap_mode='r'), hw0
+
+    def store(self, entry, im):
+        # Concurrent runs may write the same entry; the rename makes it atomic
+        os.makedirs(entry.parent, exist_ok=True)
+        tmp_path = f'{entry}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(im))
+        os.replace(tmp_path, entry)
+
+    def save_index(self):
+        os.makedirs(self.root, exist_ok=True)
+        # Merge with entries other runs wrote in the meantime
+        merged = {}
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, 'r') as f:
+                    merged = json.load(f)
+            except json.JSONDecodeError:
+                pass
+        merged.update(self.index)
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(merged, f)
+        os.replace(tmp_path, self.index_path)
+
+
+def warm_one(args):
+    path, imgsz, root = args
+    cache = ImageCache(imgsz, root)
+    cache.index = {}
+    cache.get(path)
+    return cache.index, cache.misses
+
+
+def warm(paths, imgsz=640, root=cache_dir, workers=None, chunksize=16):
+    cache = ImageCache(imgsz, root)
+    start = time.perf_counter()
+    n_decoded = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for index, misses in pool.map(warm_one, [(str(p), imgsz, root) for p in paths],
+                                      chunksize=chunksize):
+            cache.index.update(index)
+            n_decoded += misses
+    cache.save_index()
+    elapsed = time.perf_counter() - start
+    print(f'Image cache {cache.dir}: {len(paths)} images, {n_decoded} decoded in {elapsed:.1f}s')
+    return cache
+
+
+def iter_images(image_dirs):
+    for image_dir in image_dirs:
+        for root, _, files in os.walk(image_dir):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, name)
+
+
+def bench_load(paths, imgsz=640, root=cache_dir):
+    # Per-image load time: decode + resize vs copy out of the cache
+    start = time.perf_counter()
+    for p in paths:
+        resize_like_ultralytics(cv2.imread(p), imgsz)
+    decode_time = time.perf_counter() - start
+
+    cache = ImageCache(imgsz, root)
+    start = time.perf_counter()
+    for p in paths:
+        np.array(cache.get(p)[0])
+    cache_time = time.perf_counter() - start
+    n = max(len(paths), 1)
+    print(f'decode+resize {decode_time / n * 1000:.2f} ms/image, cache '
+          f'{cache_time / n * 1000:.2f} ms/image ({decode_time / max(cache_time, 1e-9):.1f}x), '
+          f'{cache.hits} hits / {cache.misses} misses')
+    return decode_time, cache_time
+
+
+# %%
+
+# Ultralytics adapter
+
+
+def cached_dataset_class():
+    from ultralytics.data import YOLODataset
+
+    class CachedYOLODataset(YOLODataset):
+        # Images come from the shared cache instead of cv2.imread + resize.
+        # Each load copies out of the mmap, so augmentations never write to it.
+        def __init__(self, *args, image_cache=None, **kwargs):
+            self.image_cache = image_cache
+            super().__init__(*args, **kwargs)
+
+        def load_image(self, i, rect_mode=True):
+            if not rect_mode or self.image_cache is None or self.ims[i] is not None:
+                return super().load_image(i, rect_mode)
+            im, hw0 = self.image_cache.get(self.im_files[i])
+            im, hw0 = np.array(im), tuple(hw0)
+            # Same buffer bookkeeping as BaseDataset.load_image: Mosaic and
+            # MixUp pick their extra images from self.buffer
+            if self.augment:
+                self.ims[i], self.im_hw0[i], self.im_hw[i] = im, hw0, im.shape[:2]
+                self.buffer.append(i)
+                if 1 < len(self.buffer) >= self.max_buffer_length:
+                    j = self.buffer.pop(0)
+                    if self.cache != "ram":
+                        self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+            return im, hw0, im.shape[:2]
+
+    return CachedYOLODataset
+
+
+def cached_trainer_class(imgsz_cache_dir=cache_dir):
+    from ultralytics.models.yolo.detect import DetectionTrainer
+    from ultralytics.utils import colorstr
+    from ultralytics.utils.torch_utils import de_parallel
+
+    CachedYOLODataset = cached_dataset_class()
+
+    class CachedDetectionTrainer(DetectionTrainer):
+        # Same arguments as ultralytics.data.build.build_yolo_dataset
+        def build_dataset(self, img_path, mode="train", batch=None):
+            gs = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+            cfg = self.args
+            dataset = CachedYOLODataset(
+                img_path=img_path,
+                imgsz=cfg.imgsz,
+                batch_size=batch,
+                augment=mode == "train",
+                hyp=cfg,
+                rect=cfg.rect or mode == "val",
+                cache=cfg.cache or None,
+                single_cls=cfg.single_cls or False,
+                stride=int(gs),
+                pad=0.0 if mode == "train" else 0.5,
+                prefix=colorstr(f"{mode}: "),
+                task=cfg.task,
+                classes=cfg.classes,
+                data=self.data,
+                fraction=cfg.fraction if mode == "train" else 1.0,
+            )
+            # Warm up front so dataloader workers only ever hit the cache
+            dataset.image_cache = warm(dataset.im_files, cfg.imgsz, imgsz_cache_dir)
+            return dataset
+
+    return CachedDetectionTrainer
+
+
+def epoch_timer(model):
+    # Collects trainer.epoch_time of every epoch
+    times = []
+    model.add_callback("on_fit_epoch_end", lambda trainer: times.append(trainer.epoch_time))
+    return times
+
+
+def compare_epoch_times(weights, data, epochs=3, imgsz=640, **train_args):
+    # Same short training run with and without the cache
+    from ultralytics import YOLO
+
+    report = {}
+    for name, trainer in (("baseline", None), ("image_cache", cached_trainer_class())):
+        model = YOLO(weights)
+        times = epoch_timer(model)
+        model.train(data=data, epochs=epochs, imgsz=imgsz, trainer=trainer, plots=False,
+                    **train_args)
+        # The first epoch includes warm-up (and filling the cache on a cold run)
+        report[name] = float(np.median(times[1:] if len(times) > 1 else times))
+    reduction = 1 - report["image_cache"] / report["baseline"]
+    print(f"Median epoch time: {report['baseline']:.1f}s -> {report['image_cache']:.1f}s "
+          f"({reduction:.0%} less)")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm or benchmark the decoded image cache')
+    parser.add_argument('image_dirs', nargs='+')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--cache-dir', default=str(cache_dir))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--bench', action='store_true', help='Compare load time per image')
+    args = parser.parse_args()
+
+    paths = list(iter_images(args.image_dirs))
+    warm(paths, args.imgsz, Path(args.cache_dir), args.workers)
+    if args.bench:
+        bench_load(paths, args.imgsz, Path(args.cache_dir))
+
+
+if __name__ == '__main__':
+    main()
+
+# %%
@@ -0,0 +1,252 @@
+# ------------------------------------------------------------------
+# Description: Local inference service that keeps the YOLO model resident.
+# Requests (image paths or encoded image bytes) arriving close together
+# are grouped into dynamic batches, bounded by a max batch size and a
+# max-latency deadline. Serves HTTP on a TCP port or a Unix socket and
+# runs on CPU-only machines.
+#
+# python inference_server.py --weights best.pt --port 8765
+# python inference_server.py --weights best.pt --socket /tmp/yolo.sock
+#
+# POST /predict   {"paths": [...]} or raw image bytes
+# GET  /metrics   queue depth, batch size histogram, p50/p99 latency
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from batch_inference import best_weights_path, detections_to_record, result_to_detections
+
+
+class DynamicBatcher:
+    def __init__(self, model, max_batch=16, max_latency_ms=10, imgsz=640, conf=0.25,
+                 device='cpu'):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self.predict_kwargs = dict(imgsz=imgsz, conf=conf, device=device, verbose=False)
+
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=10000)
+        self.n_requests = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def warmup(self, imgsz=640):
+        self.model.predict(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), **self.predict_kwargs)
+
+    def submit(self, image):
+        future = Future()
+        self.requests.put((image, future, time.perf_counter()))
+        return future
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        # Wait for more requests until the oldest one hits its deadline
+        deadline = batch[0][2] + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self.requests.get(timeout=timeout))
+                else:
+                    # Past the deadline, only take what is already queued
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                results = self.model.predict([image for image, _, _ in batch], **self.predict_kwargs)
+                detections = [result_to_detections(r) for r in results]
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            done = time.perf_counter()
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                self.n_requests += len(batch)
+                self.latencies.extend(done - t for _, _, t in batch)
+            for (_, future, _), det in zip(batch, detections):
+                future.set_result(det)
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            return {
+                'queue_depth': self.requests.qsize(),
+                'requests': self.n_requests,
+                'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'latency_ms': {
+                    'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                    'p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                },
+            }
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    batcher = None
+    names = None
+
+    def address_string(self):
+        # Unix socket clients have no host/port
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(self.batcher.metrics())
+        elif self.path == '/health':
+            self.send_json({'status': 'ok'})
+        else:
+            self.send_json({'error': f'Unknown path {self.path}'}, 404)
+
+    def read_images(self):
+        # JSON {"path": ...} / {"paths": [...]} of server-side files, or the
+        # encoded image as the raw body
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise TypeError('expected a JSON object')
+            paths = request.get('paths') or [request['path']]
+            if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+                raise TypeError('path(s) must be strings')
+            return paths, [cv2.imread(p) for p in paths]
+        if not body:
+            raise ValueError('empty body')
+        return [None], [cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)]
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json({'error': f'Unknown path {self.path}'}, 404)
+            return
+
+        try:
+            paths, images = self.read_images()
+        except (ValueError, KeyError, TypeError, cv2.error) as e:
+            self.send_json({'error': f'Bad request: {e!r}'}, 400)
+            return
+
+        if any(image is None for image in images):
+            missing = [p for p, image in zip(paths, images) if image is None]
+            self.send_json({'error': f'Could not read images: {missing}'}, 400)
+            return
+
+        # Each image is its own request so they batch with other clients
+        futures = [self.batcher.submit(image) for image in images]
+        records = [
+            detections_to_record(path, image.shape, *future.result(), self.names)
+            for path, image, future in zip(paths, images, futures)
+        ]
+        self.send_json({'results': records})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(weights=best_weights_path, host='127.0.0.1', port=8765, unix_socket=None,
+          max_batch=16, max_latency_ms=10, imgsz=640, conf=0.25, device='cpu'):
+    from ultralytics import YOLO
+
+    model = YOLO(weights)
+    batcher = DynamicBatcher(model, max_batch, max_latency_ms, imgsz, conf, device)
+    batcher.warmup(imgsz)
+
+    handler = type('Handler', (InferenceHandler,), {'batcher': batcher, 'names': model.names})
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, handler)
+        print(f'Serving {weights} on unix:{unix_socket}')
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f'Serving {weights} on http://{host}:{port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def predict(paths, host='127.0.0.1', port=8765, unix_socket=None):
+    # Client helper: detections for image paths from a running server
+    conn = UnixHTTPConnection(unix_socket) if unix_socket else http.client.HTTPConnection(host, port)
+    try:
+        body = json.dumps({'paths': [str(Path(p).resolve()) for p in paths]})
+        conn.request('POST', '/predict', body, {'Content-Type': 'application/json'})
+        response = json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response['results']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resident YOLO inference server')
+    parser.add_argument('--weights', default=str(best_weights_path))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', default=None, help='Serve on a Unix socket instead')
+    parser.add_argument('--max-batch', type=int, default=16)
+    parser.add_argument('--max-latency-ms', type=float, default=10)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    serve(args.weights, args.host, args.port, args.socket, args.max_batch,
+          args.max_latency_ms, args.imgsz, args.conf, args.device)
+
+
+if __name__ == '__main__':
+    main()
+
+# %%
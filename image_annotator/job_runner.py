@@ -0,0 +1,468 @@
+# ------------------------------------------------------------------
+# Description: Sharded, resumable batch inference over many chips.
+# `plan` splits the chip list into deterministic shards (crc32 of the file
+# name, so adding chips does not reshuffle existing shards) under a job
+# directory. `work` claims shards through lease files created with
+# O_CREAT | O_EXCL, keeps them alive with a heartbeat, writes each shard's
+# detections and then a done marker. Any number of `work` processes on any
+# number of machines can share one job directory on a shared filesystem;
+# leases whose heartbeat stopped are taken over (at once when the owner was
+# a process on this host that no longer exists), failed shards are retried
+# up to max_attempts. A worker only heartbeats, publishes and releases a
+# shard while the lease still carries its own claim token. `merge`
+# concatenates the shard outputs in order.
+# Rerunning `work` after a crash only processes shards without a marker.
+#
+# python job_runner.py plan jobs/national chips --shards 256
+# python job_runner.py work jobs/national --workers 4     # on every node
+# python job_runner.py status jobs/national
+# python job_runner.py merge jobs/national --out detections.parquet
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+import argparse
+import json
+import multiprocessing as mp
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+import zlib
+
+from batch_inference import (
+    JsonlWriter,
+    ParquetWriter,
+    best_weights_path,
+    detections_to_record,
+    iter_image_paths,
+    predict_batches,
+    prefetch_decode,
+)
+
+LEASE_TTL = 300
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def shard_of(path, n_shards):
+    return zlib.crc32(os.path.basename(path).encode()) % n_shards
+
+
+def shard_name(shard):
+    return f"shard_{shard:05d}"
+
+
+def plan_job(job_dir, inputs, n_shards=64, out_format="parquet", max_attempts=3):
+    job_dir = Path(job_dir)
+    plan_path = job_dir / "plan.json"
+    if plan_path.exists():
+        raise FileExistsError(f"{job_dir} already has a plan; use a new job directory")
+    for sub in ("shards", "leases", "done", "out", "attempts"):
+        os.makedirs(job_dir / sub, exist_ok=True)
+
+    shards = [[] for _ in range(n_shards)]
+    for path in iter_image_paths(inputs):
+        shards[shard_of(path, n_shards)].append(os.path.abspath(path))
+    for shard, paths in enumerate(shards):
+        with open(job_dir / "shards" / f"{shard_name(shard)}.txt", "w") as f:
+            f.writelines(p + "\n" for p in sorted(paths))
+
+    plan = {"n_shards": n_shards, "inputs": [str(i) for i in inputs], "format": out_format,
+            "max_attempts": max_attempts, "n_images": sum(len(s) for s in shards),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with open(f"{plan_path}.tmp", "w") as f:
+        json.dump(plan, f, indent=2)
+    os.replace(f"{plan_path}.tmp", plan_path)
+    print(f"Planned {plan['n_images']} images in {n_shards} shards under {job_dir}")
+    return plan
+
+
+def load_plan(job_dir):
+    with open(Path(job_dir) / "plan.json", "r") as f:
+        return json.load(f)
+
+
+class ShardQueue:
+    # Work queue on a (shared) filesystem; all state lives in files
+    def __init__(self, job_dir, lease_ttl=LEASE_TTL):
+        self.job_dir = Path(job_dir)
+        self.plan = load_plan(job_dir)
+        self.lease_ttl = lease_ttl
+        self.host = socket.gethostname()
+        self.owner = f"{self.host}:{os.getpid()}"
+        self.tokens = {}
+
+    def lease_path(self, shard):
+        return self.job_dir / "leases" / f"{shard_name(shard)}.lease"
+
+    def done_path(self, shard):
+        return self.job_dir / "done" / f"{shard_name(shard)}.done"
+
+    def attempts_path(self, shard):
+        return self.job_dir / "attempts" / f"{shard_name(shard)}.json"
+
+    def output_path(self, shard):
+        return self.job_dir / "out" / f"{shard_name(shard)}.{self.plan['format']}"
+
+    def attempts(self, shard):
+        try:
+            with open(self.attempts_path(shard), "r") as f:
+                return json.load(f)["attempts"]
+        except FileNotFoundError:
+            return 0
+
+    def is_done(self, shard):
+        return self.done_path(shard).exists()
+
+    def try_claim(self, shard):
+        path = self.lease_path(shard)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.break_stale(path):
+                    return False
+                continue
+            token = uuid.uuid4().hex
+            with os.fdopen(fd, "w") as f:
+                json.dump({"owner": self.owner, "token": token, "claimed": time.time()}, f)
+            self.tokens[shard] = token
+            # The shard may have finished between the listing and the claim
+            if self.is_done(shard):
+                self.release(shard)
+                return False
+            return True
+        return False
+
+    def read_lease(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Missing, or created but not written yet
+            return {}
+
+    def owner_is_dead(self, lease):
+        # Only decidable for a process on this host
+        host, _, pid = lease.get("owner", "").rpartition(":")
+        if host != self.host or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def break_stale(self, path):
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
+            return True
+        dead = self.owner_is_dead(self.read_lease(path))
+        if age < self.lease_ttl and not dead:
+            return False
+        # rename is atomic, so only one worker takes over a dead lease
+        try:
+            os.rename(path, f"{path}.stale.{self.owner.replace(':', '.')}")
+        except FileNotFoundError:
+            return True
+        reason = "owner process is gone" if dead else f"no heartbeat for {age:.0f}s"
+        print(f"Took over {os.path.basename(path)}, {reason}")
+        return True
+
+    def owns(self, shard):
+        token = self.tokens.get(shard)
+        return token is not None and self.read_lease(self.lease_path(shard)).get("token") == token
+
+    def heartbeat(self, shard):
+        # False once another worker has taken the lease over
+        if not self.owns(shard):
+            return False
+        try:
+            os.utime(self.lease_path(shard))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self, shard):
+        token = self.tokens.pop(shard, None)
+        if token is None:
+            return
+        # Move the lease to a name only this claim uses before checking it;
+        # the rename is atomic, so a takeover cannot slip in between the
+        # check and the delete
+        path = self.lease_path(shard)
+        held = f"{path}.release.{token}"
+        try:
+            os.rename(path, held)
+        except FileNotFoundError:
+            return
+        if self.read_lease(held).get("token") != token:
+            # Taken over already: put the new owner's lease back, unless a
+            # fresh claim has been made in the meantime
+            try:
+                os.link(held, path)
+            except FileExistsError:
+                pass
+        os.remove(held)
+
+    def mark_done(self, shard, stats):
+        path = self.done_path(shard)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(dict(stats, owner=self.owner, finished=time.time()), f)
+        os.replace(f"{path}.tmp", path)
+
+    def mark_failed(self, shard, error):
+        path = self.attempts_path(shard)
+        attempts = self.attempts(shard) + 1
+        with open(f"{path}.tmp", "w") as f:
+            json.dump({"attempts": attempts, "last_error": error, "owner": self.owner}, f)
+        os.replace(f"{path}.tmp", path)
+        return attempts
+
+    def pending(self):
+        max_attempts = self.plan["max_attempts"]
+        return [
+            shard for shard in range(self.plan["n_shards"])
+            if not self.is_done(shard) and self.attempts(shard) < max_attempts
+        ]
+
+    def claim_next(self, start=0):
+        # Workers start at different offsets so they rarely race for a shard
+        pending = self.pending()
+        if not pending:
+            return None
+        k = start % len(pending)
+        for shard in pending[k:] + pending[:k]:
+            if self.try_claim(shard):
+                return shard
+        return None
+
+    def shard_paths(self, shard):
+        with open(self.job_dir / "shards" / f"{shard_name(shard)}.txt", "r") as f:
+            return [line.strip() for line in f if line.strip()]
+
+
+class Heartbeat:
+    def __init__(self, queue, shard):
+        self.queue = queue
+        self.shard = shard
+        self.stop = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop.wait(self.queue.lease_ttl / 3):
+            if not self.queue.heartbeat(self.shard):
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        return False
+
+
+def run_shard(queue, shard, model, names, batch_size, imgsz, conf, device, decode_workers,
+              lost=None):
+    out_path = queue.output_path(shard)
+    tmp_path = f"{out_path}.{queue.owner.replace(':', '.')}.tmp"
+    # Written under a temporary name; a crash never leaves a half shard behind
+    if queue.plan["format"] == "parquet":
+        writer = ParquetWriter(tmp_path)
+    else:
+        writer = JsonlWriter(tmp_path)
+    try:
+        with writer:
+            stats = write_shard(queue, shard, writer, model, names, batch_size, imgsz, conf,
+                                device, decode_workers, lost)
+        # Only the lease holder publishes the shard. A takeover between this
+        # check and the rename needs the lease to have gone stale while the
+        # heartbeat is still running; both workers then write the same shard,
+        # and os.replace leaves one complete copy.
+        if not queue.owns(shard):
+            raise LeaseLost(shard_name(shard))
+        os.replace(tmp_path, out_path)
+        return stats
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_shard(queue, shard, writer, model, names, batch_size, imgsz, conf, device,
+                decode_workers, lost):
+    n_images = n_detections = n_failed = 0
+
+    def decoded():
+        nonlocal n_failed
+        for path, image in prefetch_decode(queue.shard_paths(shard), decode_workers):
+            if image is None:
+                n_failed += 1
+                continue
+            yield path, image
+
+    for path, image, (boxes, classes, confidences) in predict_batches(
+        model, decoded(), batch_size, imgsz, conf, device
+    ):
+        if lost is not None and lost.is_set():
+            raise LeaseLost(shard_name(shard))
+        writer.write(detections_to_record(path, image.shape, boxes, classes, confidences, names))
+        n_images += 1
+        n_detections += len(boxes)
+    return {"images": n_images, "detections": n_detections, "unreadable": n_failed}
+
+
+def work(job_dir, worker_id=0, weights=best_weights_path, batch_size=16, imgsz=640, conf=0.25,
+         device=None, decode_workers=4, lease_ttl=LEASE_TTL):
+    from ultralytics import YOLO
+
+    queue = ShardQueue(job_dir, lease_ttl)
+    model = YOLO(weights)
+    n_shards = 0
+    while True:
+        shard = queue.claim_next(start=worker_id * 7919)
+        if shard is None:
+            if not queue.pending():
+                break
+            # Everything left is leased; stay around to take over leases of
+            # workers that die
+            time.sleep(queue.lease_ttl / 3)
+            continue
+        start = time.perf_counter()
+        try:
+            with Heartbeat(queue, shard) as heartbeat:
+                stats = run_shard(queue, shard, model, model.names, batch_size, imgsz, conf,
+                                  device, decode_workers, heartbeat.lost)
+            queue.mark_done(shard, dict(stats, seconds=time.perf_counter() - start))
+            n_shards += 1
+            print(f"[{queue.owner}] {shard_name(shard)}: {stats['images']} images in "
+                  f"{time.perf_counter() - start:.1f}s")
+        except LeaseLost:
+            # Another worker took the shard over; it is theirs to finish
+            print(f"[{queue.owner}] lost the lease on {shard_name(shard)}, dropping it")
+        except Exception:
+            attempts = queue.mark_failed(shard, traceback.format_exc(limit=5))
+            print(f"[{queue.owner}] {shard_name(shard)} failed (attempt {attempts}):\n"
+                  f"{traceback.format_exc(limit=1)}")
+        finally:
+            queue.release(shard)
+    return n_shards
+
+
+def work_pool(job_dir, workers=1, **kwargs):
+    # Separate processes, each with its own model instance
+    if workers == 1:
+        return work(job_dir, 0, **kwargs)
+    ctx = mp.get_context("spawn")
+    processes = [
+        ctx.Process(target=work, args=(job_dir, i), kwargs=kwargs) for i in range(workers)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+
+def status(job_dir):
+    queue = ShardQueue(job_dir)
+    n = queue.plan["n_shards"]
+    done = [s for s in range(n) if queue.is_done(s)]
+    leased = [s for s in range(n) if s not in done and queue.lease_path(s).exists()]
+    failed = [s for s in range(n) if s not in done
+              and queue.attempts(s) >= queue.plan["max_attempts"]]
+    images = 0
+    for s in done:
+        with open(queue.done_path(s), "r") as f:
+            images += json.load(f)["images"]
+    print(f"{len(done)}/{n} shards done ({images}/{queue.plan['n_images']} images), "
+          f"{len(leased)} running, {len(failed)} failed for good, "
+          f"{n - len(done) - len(leased) - len(failed)} waiting")
+    return done, leased, failed
+
+
+def merge(job_dir, out, allow_partial=False):
+    queue = ShardQueue(job_dir)
+    n = queue.plan["n_shards"]
+    missing = [s for s in range(n) if not queue.is_done(s)]
+    if missing and not allow_partial:
+        raise RuntimeError(f"{len(missing)} shards are not done, e.g. {shard_name(missing[0])}")
+    shards = [s for s in range(n) if queue.is_done(s)]
+
+    if queue.plan["format"] == "parquet":
+        import pyarrow.parquet as pq
+
+        writer = None
+        for s in shards:
+            table = pq.read_table(queue.output_path(s))
+            if writer is None:
+                writer = pq.ParquetWriter(out, table.schema)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+    else:
+        with open(out, "wb") as dst:
+            for s in shards:
+                with open(queue.output_path(s), "rb") as src:
+                    dst.write(src.read())
+    print(f"Merged {len(shards)} shards into {out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded, resumable batch inference")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("plan", help="Split the chip list into shards")
+    p.add_argument("job_dir")
+    p.add_argument("inputs", nargs="+", help="Chip directories, files or .txt path lists")
+    p.add_argument("--shards", type=int, default=64)
+    p.add_argument("--format", default="parquet", choices=["parquet", "jsonl"])
+    p.add_argument("--max-attempts", type=int, default=3)
+
+    p = sub.add_parser("work", help="Process shards until none are left")
+    p.add_argument("job_dir")
+    p.add_argument("--workers", type=int, default=1, help="Processes on this node")
+    p.add_argument("--weights", default=str(best_weights_path))
+    p.add_argument("--batch-size", type=int, default=16)
+    p.add_argument("--imgsz", type=int, default=640)
+    p.add_argument("--conf", type=float, default=0.25)
+    p.add_argument("--device", default=None)
+    p.add_argument("--lease-ttl", type=float, default=LEASE_TTL,
+                   help="Seconds without heartbeat before a lease is taken over")
+
+    p = sub.add_parser("status")
+    p.add_argument("job_dir")
+
+    p = sub.add_parser("merge")
+    p.add_argument("job_dir")
+    p.add_argument("--out", required=True)
+    p.add_argument("--allow-partial", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        plan_job(args.job_dir, args.inputs, args.shards, args.format, args.max_attempts)
+    elif args.command == "work":
+        work_pool(args.job_dir, args.workers, weights=args.weights, batch_size=args.batch_size,
+                  imgsz=args.imgsz, conf=args.conf, device=args.device,
+                  lease_ttl=args.lease_ttl)
+        status(args.job_dir)
+    elif args.command == "status":
+        status(args.job_dir)
+    else:
+        merge(args.job_dir, args.out, args.allow_partial)
+
+
+if __name__ == "__main__":
+    main()
+
+# %%
@@ -0,0 +1,182 @@
+# ------------------------------------------------------------------
+# Description: Consolidated label store for the YOLO annotation corpus.
+# All boxes of yolo_annotations/ live in one float32 array with class,
+# image-id and per-image offset arrays, saved as .npy files that are
+# memory-mapped on load. The store is re-synced from the txt files by
+# comparing their mtime/size, so only edited files are parsed again.
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import os
+import json
+import time
+
+import numpy as np
+
+from tracing import traced
+
+labels_dir = Path('yolo_annotations')
+store_dir = Path('label_store')
+
+STORE_VERSION = 1
+ARRAYS = ('boxes', 'classes', 'image_ids', 'offsets')
+
+
+def parse_yolo_file(path):
+    with open(path, 'r') as f:
+        values = f.read().split()
+    rows = np.array(values, dtype=np.float32).reshape(-1, 5)
+    return rows[:, 0].astype(np.int16), rows[:, 1:]
+
+
+def scan_labels(labels_dir):
+    stats = {}
+    for entry in os.scandir(labels_dir):
+        if entry.name.endswith('.txt'):
+            st = entry.stat()
+            stats[entry.name[:-4]] = [st.st_mtime_ns, st.st_size]
+    return stats
+
+
+def read_index(store_dir):
+    try:
+        with open(os.path.join(store_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if index.get('version') != STORE_VERSION:
+        return None
+    return index
+
+
+@traced("label_store.build")
+def build_label_store(labels_dir=labels_dir, store_dir=store_dir, workers=16):
+    start = time.perf_counter()
+    os.makedirs(store_dir, exist_ok=True)
+    stats = scan_labels(labels_dir)
+    names = sorted(stats)
+
+    index = read_index(store_dir)
+    old = None
+    if index is not None:
+        if index['names'] == names and index['stats'] == [stats[n] for n in names]:
+            return index
+        old = LabelStore(store_dir)
+        old_stats = dict(zip(index['names'], index['stats']))
+
+    reuse = {}
+    to_parse = []
+    for name in names:
+        if old is not None and old_stats.get(name) == stats[name]:
+            reuse[name] = old[name]
+        else:
+            to_parse.append(name)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parsed = dict(zip(
+            to_parse,
+            pool.map(parse_yolo_file, [os.path.join(labels_dir, n + '.txt') for n in to_parse]),
+        ))
+
+    per_image = [reuse[n] if n in reuse else parsed[n] for n in names]
+    counts = np.array([len(c) for c, _ in per_image], dtype=np.int64)
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    arrays = {
+        'boxes': np.concatenate([b for _, b in per_image] or [np.zeros((0, 4))]).astype(np.float32),
+        'classes': np.concatenate([c for c, _ in per_image] or [np.zeros(0)]).astype(np.int16),
+        'image_ids': np.repeat(np.arange(len(names), dtype=np.int32), counts),
+        'offsets': offsets,
+    }
+    # Copy out of the old mmaps before their files are replaced
+    del reuse, per_image, old
+
+    # Each build writes a new generation and swaps index.json in last. The
+    # previous generation is kept, so a reader that read the old index just
+    # before the swap can still load its arrays; older ones are removed.
+    generation = (index['generation'] + 1) if index is not None else 0
+    for key, arr in arrays.items():
+        np.save(os.path.join(store_dir, f'{key}.{generation}.npy'), arr)
+
+    new_index = {
+        'version': STORE_VERSION,
+        'generation': generation,
+        'names': names,
+        'stats': [stats[n] for n in names],
+    }
+    tmp_path = os.path.join(store_dir, 'index.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(new_index, f)
+    os.replace(tmp_path, os.path.join(store_dir, 'index.json'))
+
+    for entry in os.scandir(store_dir):
+        parts = entry.name.split('.')
+        if (len(parts) == 3 and parts[0] in ARRAYS and parts[1].isdigit()
+                and int(parts[1]) < generation - 1):
+            os.remove(entry.path)
+
+    elapsed = time.perf_counter() - start
+    print(f'Label store: {len(names)} images, {len(arrays["classes"])} boxes, '
+          f'{len(to_parse)} files parsed in {elapsed:.2f}s')
+    return new_index
+
+
+class LabelStore:
+    def __init__(self, store_dir=store_dir, mmap=True):
+        self.store_dir = store_dir
+        self.index = read_index(store_dir)
+        if self.index is None:
+            raise FileNotFoundError(f'No label store in {store_dir}')
+        self.names = self.index['names']
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+        mmap_mode = 'r' if mmap else None
+        generation = self.index['generation']
+        for key in ARRAYS:
+            path = os.path.join(store_dir, f'{key}.{generation}.npy')
+            setattr(self, key, np.load(path, mmap_mode=mmap_mode))
+
+    @classmethod
+    def open(cls, labels_dir=labels_dir, store_dir=store_dir, mmap=True):
+        # Sync with the txt files first; a no-op when nothing changed
+        build_label_store(labels_dir, store_dir)
+        return cls(store_dir, mmap=mmap)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, key):
+        # Views into the store, nothing is copied
+        i = self.ids[key] if isinstance(key, str) else key
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.classes[start:end], self.boxes[start:end]
+
+    def __iter__(self):
+        for i, name in enumerate(self.names):
+            yield (name,) + self[i]
+
+    def box_counts(self):
+        return np.diff(self.offsets)
+
+    def class_counts(self, nc=None):
+        return np.bincount(self.classes, minlength=nc or 0)
+
+    def export_yolo(self, out_dir, names=None):
+        # Write back per-file YOLO txt labels for Ultralytics
+        os.makedirs(out_dir, exist_ok=True)
+        for name in names or self.names:
+            classes, boxes = self[name]
+            with open(os.path.join(out_dir, name + '.txt'), 'w') as f:
+                f.write(''.join(
+                    f'{c} {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n'
+                    for c, (x, y, w, h) in zip(classes.tolist(), boxes.tolist())
+                ))
+
+
+if __name__ == '__main__':
+    store = LabelStore.open(labels_dir, store_dir)
+    print(f'{len(store)} images, boxes per class: {store.class_counts().tolist()}')
+
+# %%
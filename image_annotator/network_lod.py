@@ -0,0 +1,85 @@
+# ------------------------------------------------------------------
+# Description: Level-of-detail index over the transmission network.
+# The lines are split into parts and simplified once per zoom level with a
+# tolerance of half a screen pixel at that zoom; parts shorter than a few
+# pixels are left out of the coarse levels. An STRtree over the parts
+# answers viewport bbox queries, and each part/level is encoded as a
+# Google encoded polyline (decoded in the page with
+# google.maps.geometry.encoding.decodePath) on first use.
+# ------------------------------------------------------------------
+# %%
+from functools import lru_cache
+
+import numpy as np
+import shapely
+
+# Coarsest to finest; a viewport uses the finest level at or below its zoom
+LOD_ZOOMS = (4, 6, 8, 10, 12, 14, 16, 18)
+MIN_PIXELS = 3
+MAX_LINES = 4000
+
+
+def pixel_degrees(zoom):
+    # Width of one 256-px-tile screen pixel in degrees of longitude
+    return 360 / (256 * 2**zoom)
+
+
+def encode_polyline(coords):
+    # coords: (n, 2) lon/lat -> Google encoded polyline string (lat/lng order)
+    values = np.round(np.asarray(coords)[:, ::-1] * 1e5).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), np.int64)).ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    # 5-bit chunks, low first, continuation bit on all but the last
+    shifts = np.arange(7) * 5
+    chunks = (zigzag[:, None] >> shifts) & 0x1F
+    n_chunks = 1 + ((zigzag[:, None] >> shifts[1:]) > 0).sum(axis=1)
+    used = np.arange(7) < n_chunks[:, None]
+    more = np.arange(7) < (n_chunks - 1)[:, None]
+    chars = (chunks | (more * 0x20)) + 63
+    return chars[used].astype(np.uint8).tobytes().decode("ascii")
+
+
+class NetworkLOD:
+    def __init__(self, tl_gdf, zooms=LOD_ZOOMS, max_lines=MAX_LINES):
+        self.zooms = np.asarray(zooms)
+        self.max_lines = max_lines
+        parts, self.line_of = shapely.get_parts(tl_gdf.geometry.values, return_index=True)
+        self.parts = parts
+        self.tree = shapely.STRtree(parts)
+        # Longest first when a dense viewport has to be thinned out
+        self.lengths = shapely.length(parts)
+
+        self.levels = []
+        for zoom in zooms:
+            tolerance = pixel_degrees(zoom) / 2
+            simplified = shapely.simplify(parts, tolerance, preserve_topology=False)
+            visible = self.lengths >= MIN_PIXELS * pixel_degrees(zoom)
+            self.levels.append((simplified, visible))
+        self.encoded = lru_cache(maxsize=65536)(self.encode)
+
+    def level(self, zoom):
+        i = int(np.searchsorted(self.zooms, zoom, side="right")) - 1
+        return max(i, 0)
+
+    def encode(self, level, part):
+        return encode_polyline(shapely.get_coordinates(self.levels[level][0][part]))
+
+    def query(self, west, south, east, north, zoom):
+        # Encoded polylines for the parts crossing the viewport
+        level = self.level(zoom)
+        _, visible = self.levels[level]
+        if west > east:
+            # Viewport across the antimeridian
+            hits = np.concatenate([
+                self.tree.query(shapely.box(west, south, 180, north)),
+                self.tree.query(shapely.box(-180, south, east, north)),
+            ])
+        else:
+            hits = self.tree.query(shapely.box(west, south, east, north))
+        hits = hits[visible[hits]]
+        truncated = len(hits) > self.max_lines
+        if truncated:
+            hits = hits[np.argsort(-self.lengths[hits], kind="stable")[: self.max_lines]]
+        return [self.encoded(level, int(p)) for p in np.sort(hits)], truncated
+
+# %%
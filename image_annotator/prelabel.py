@@ -0,0 +1,186 @@
+# ------------------------------------------------------------------
+# Description: Model-assisted pre-labeling for new captures.
+# A detector process keeps best.pt loaded and warm. For each saved chip it
+# writes a LabelMe JSON with the predicted rectangles next to the image,
+# labelled with the class names from prepare_annotations.existing_labels,
+# so LabelMe opens with boxes to confirm instead of an empty canvas.
+# A <stem>.prelabel marker records the JSON as written; until LabelMe saves
+# over it the chip does not count as annotated (see is_unreviewed_prelabel).
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+import itertools
+import json
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+
+from batch_inference import best_weights_path
+
+LABELME_VERSION = "5.5.0"
+
+
+def labelme_json(image_path, width, height, boxes, classes, confidences, names):
+    shapes = []
+    for (x1, y1, x2, y2), cls, conf in zip(boxes, classes, confidences):
+        shapes.append({
+            "label": names[int(cls)],
+            "points": [[float(x1), float(y1)], [float(x2), float(y2)]],
+            "group_id": None,
+            "description": f"predicted {float(conf):.2f}",
+            "shape_type": "rectangle",
+            "flags": {},
+            "mask": None,
+        })
+    return {
+        "version": LABELME_VERSION,
+        "flags": {},
+        "shapes": shapes,
+        "imagePath": os.path.basename(image_path),
+        "imageData": None,
+        "imageHeight": int(height),
+        "imageWidth": int(width),
+    }
+
+
+def prelabel_marker_path(json_path):
+    return os.path.splitext(json_path)[0] + ".prelabel"
+
+
+def write_prelabel_marker(json_path):
+    st = os.stat(json_path)
+    with open(prelabel_marker_path(json_path), "w") as f:
+        json.dump({"mtime_ns": st.st_mtime_ns, "size": st.st_size}, f)
+
+
+def is_unreviewed_prelabel(json_path):
+    # True while the JSON is still the file the detector wrote; any save
+    # from LabelMe or the annotation session changes its mtime
+    try:
+        with open(prelabel_marker_path(json_path), "r") as f:
+            marker = json.load(f)
+        st = os.stat(json_path)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return [st.st_mtime_ns, st.st_size] == [marker.get("mtime_ns"), marker.get("size")]
+
+
+def canonical_names(model_names):
+    # Model class names mapped onto the corrected LabelMe labels
+    from prepare_annotations import existing_labels
+
+    labels = set(existing_labels.values())
+    return {
+        i: existing_labels.get(name, name)
+        for i, name in model_names.items()
+        if existing_labels.get(name, name) in labels
+    }
+
+
+def serve_prelabels(weights, requests, responses, conf, imgsz, device):
+    from ultralytics import YOLO
+    import numpy as np
+
+    model = YOLO(weights)
+    names = canonical_names(model.names)
+    # Warm-up so the first real chip does not pay for lazy initialisation
+    model.predict(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), imgsz=imgsz, device=device,
+                  verbose=False)
+    responses.put(("ready", None, 0.0, None))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, image_path = request
+        start = time.perf_counter()
+        try:
+            json_path = os.path.splitext(image_path)[0] + ".json"
+            # Never overwrite an annotation a person already saved
+            if os.path.exists(json_path):
+                responses.put((request_id, None, time.perf_counter() - start, None))
+                continue
+
+            result = model.predict(image_path, imgsz=imgsz, conf=conf, device=device,
+                                   verbose=False)[0]
+            keep = [i for i, c in enumerate(result.boxes.cls.cpu().numpy()) if int(c) in names]
+            height, width = result.orig_shape
+            data = labelme_json(
+                image_path, width, height,
+                result.boxes.xyxy.cpu().numpy()[keep],
+                result.boxes.cls.cpu().numpy()[keep],
+                result.boxes.conf.cpu().numpy()[keep],
+                names,
+            )
+            with open(json_path + ".tmp", "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(json_path + ".tmp", json_path)
+            write_prelabel_marker(json_path)
+            responses.put((request_id, json_path, time.perf_counter() - start, None))
+        except Exception as e:
+            responses.put((request_id, None, time.perf_counter() - start, str(e)))
+
+
+class Prelabeler:
+    def __init__(self, weights=best_weights_path, conf=0.25, imgsz=640, device=None):
+        ctx = mp.get_context("spawn")
+        self.requests = ctx.Queue()
+        self.responses = ctx.Queue()
+        self.process = ctx.Process(
+            target=serve_prelabels,
+            args=(str(weights), self.requests, self.responses, conf, imgsz, device),
+            daemon=True,
+        )
+        self.ids = itertools.count()
+        self.callbacks = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def start(self):
+        self.process.start()
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+        return self
+
+    def listen(self):
+        while self.process.is_alive() or not self.responses.empty():
+            try:
+                request_id, json_path, elapsed, error = self.responses.get(timeout=1)
+            except queue.Empty:
+                continue
+            if request_id == "ready":
+                self.ready.set()
+                continue
+            with self.lock:
+                callback = self.callbacks.pop(request_id, None)
+            if callback is not None:
+                callback(json_path, elapsed, error)
+
+    def submit(self, image_path, callback):
+        # callback(json_path, seconds, error) runs on the listener thread
+        request_id = next(self.ids)
+        with self.lock:
+            self.callbacks[request_id] = callback
+        self.requests.put((request_id, str(Path(image_path).resolve())))
+        return request_id
+
+    def prelabel(self, image_path, timeout=1.0):
+        # Blocking variant for scripts
+        done = threading.Event()
+        result = {}
+
+        def callback(json_path, elapsed, error):
+            result.update(json_path=json_path, elapsed=elapsed, error=error)
+            done.set()
+
+        self.submit(image_path, callback)
+        done.wait(timeout)
+        return result.get("json_path")
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join(timeout=5)
+
+# %%
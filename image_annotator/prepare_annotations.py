@@ -1,8 +1,17 @@
 # %%
-from PIL import Image
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import os
 import json
+import hashlib
+import struct
+import time
+
+import numpy as np
+import yaml
+
+from tracing import span, traced
+from yolo_paths import yolo_label_path
 
 labelme_path = Path('Annotations')
 output_dir = Path('yolo_annotations')
@@ -10,78 +19,305 @@ output_dir = Path('yolo_annotations')
 labels = []
 # Some labels are not properly labeled
 # We will use this dictionary to correct the labels
-existing_labels = {'Transformer': 'Transformer', 
+existing_labels = {'Transformer': 'Transformer',
  'Circuit Breaker': 'Circuit Breaker',
- 'Transformers': 'Transformer', 
- 'transformers': 'Transformer', 
- 'Reactors': 'Reactors', 
+ 'Transformers': 'Transformer',
+ 'transformers': 'Transformer',
+ 'Reactors': 'Reactors',
  'Rectangle': 'Transformer'
  }
 
-classes = list(set(existing_labels.values()))
+# Take the class order from data.yml so the ids written here match the
+# names the model is trained with. list(set(...)) changes order with the
+# hash seed, i.e. between runs and between pool workers.
+with open(Path(__file__).resolve().parent / 'data.yml', 'r') as f:
+    classes = yaml.safe_load(f)['names']
 print(classes)
 
-def convert_labelme_to_yolo(labelme_dir, output_dir, classes):
-    
-    global labels
-    
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        
-    for file in os.listdir(labelme_dir):
-        if file.endswith('.json'):
-            with open(os.path.join(labelme_dir, file), 'r') as f:
-                data = json.load(f)
-                img_path = os.path.join(labelme_dir, data['imagePath'])
-                image_base_path = os.path.basename(img_path)
-                
-                # The images are in labelme_dir
-                img_path = os.path.join(labelme_dir, image_base_path)
-        
-                img = Image.open(img_path)
-                img_w, img_h = img.size
-                
-                yolo_file = os.path.join(output_dir, file.replace('.json', '.txt'))
-                with open(yolo_file, 'w') as f:
-                    for shape in data['shapes']:
-                        label = shape['label']
-                        label = existing_labels.get(label, label)
-                        
-                        if label not in classes:
-                            print(f'Unknown label: {label}')
-                            continue
-
-                        class_id = classes.index(label)
-                        shape_type = shape['shape_type']
-                        points = shape['points']
-
-                        if shape_type == 'rectangle':
-                            x1, y1 = points[0]
-                            x2, y2 = points[1]
-                        elif shape_type == 'polygon':
-                            x_coords = [p[0] for p in points]
-                            y_coords = [p[1] for p in points]
-                            x1, y1 = min(x_coords), min(y_coords)
-                            x2, y2 = max(x_coords), max(y_coords)
-                        else:
-                            print(f'Unsupported shape type: {shape_type}')
-                            continue
-
-                        # Convert to YOLO format
-                        x_center = (x1 + x2) / 2 / img_w
-                        y_center = (y1 + y2) / 2 / img_h
-                        width = abs(x2 - x1) / img_w
-                        height = abs(y2 - y1) / img_h
-                        
-                        yololabel = f'{class_id} {x_center} {y_center} {width} {height}\n'
-
-                        f.write(yololabel)
-
-
-convert_labelme_to_yolo(labelme_path, output_dir, classes)
-
-
-print(set(labels))
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def read_png_size(img_path):
+    # Width and height sit in the IHDR chunk right after the signature,
+    # so 24 bytes are enough and the image is never decoded.
+    with open(img_path, 'rb') as f:
+        head = f.read(24)
+    if len(head) < 24 or head[:8] != PNG_SIGNATURE or head[12:16] != b'IHDR':
+        raise ValueError(f'Not a PNG file: {img_path}')
+    return struct.unpack('>II', head[16:24])
+
+
+def get_image_path(data, labelme_dir):
+    # The images are in labelme_dir
+    return os.path.join(labelme_dir, os.path.basename(data['imagePath']))
+
+
+def get_image_size(data, labelme_dir):
+    # LabelMe already stores the image size in the JSON
+    if data.get('imageWidth') and data.get('imageHeight'):
+        return data['imageWidth'], data['imageHeight']
+
+    img_path = get_image_path(data, labelme_dir)
+    try:
+        return read_png_size(img_path)
+    except ValueError:
+        from PIL import Image
+
+        with Image.open(img_path) as img:
+            return img.size
+
+
+def shapes_to_yolo(shapes, img_w, img_h, classes, label_map=existing_labels):
+    class_ids = []
+    counts = []
+    points = []
+    for shape in shapes:
+        label = shape['label']
+        label = label_map.get(label, label)
+
+        if label not in classes:
+            print(f'Unknown label: {label}')
+            continue
+
+        shape_type = shape['shape_type']
+        if shape_type not in ('rectangle', 'polygon'):
+            print(f'Unsupported shape type: {shape_type}')
+            continue
+
+        if not shape['points']:
+            print(f'Shape without points: {label}')
+            continue
+
+        class_ids.append(classes.index(label))
+        counts.append(len(shape['points']))
+        points.extend(shape['points'])
+
+    if not class_ids:
+        return np.zeros((0, 5), dtype=np.float64)
+
+    # All points of all shapes in one array; the bounding box of each
+    # shape (rectangle corners or polygon vertices) is a segment reduce.
+    points = np.asarray(points, dtype=np.float64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    mins = np.minimum.reduceat(points, starts, axis=0)
+    maxs = np.maximum.reduceat(points, starts, axis=0)
+
+    # Convert to YOLO format
+    size = np.array([img_w, img_h], dtype=np.float64)
+    centers = (mins + maxs) / 2 / size
+    wh = (maxs - mins) / size
+    return np.column_stack((class_ids, centers, wh))
+
+
+def write_yolo_labels(yolo_file, rows):
+    lines = ''.join(
+        f'{int(r[0])} {r[1]:.6f} {r[2]:.6f} {r[3]:.6f} {r[4]:.6f}\n' for r in rows
+    )
+    # Written to a temp file and swapped in, so a label hardlinked into a
+    # frozen dataset/ split keeps its old contents instead of being edited
+    tmp_file = f'{yolo_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(lines)
+    os.replace(tmp_file, yolo_file)
+
+
+def convert_labelme_file(json_path, labelme_dir, output_dir, classes, label_map=existing_labels):
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+
+    img_w, img_h = get_image_size(data, labelme_dir)
+    rows = shapes_to_yolo(data['shapes'], img_w, img_h, classes, label_map)
+
+    yolo_file = os.path.join(output_dir, os.path.basename(json_path).replace('.json', '.txt'))
+    write_yolo_labels(yolo_file, rows)
+    return yolo_file, get_image_path(data, labelme_dir), (img_w, img_h), len(rows)
+
+
+def _convert_chunk(json_paths, labelme_dir, output_dir, classes, label_map):
+    return [
+        convert_labelme_file(p, labelme_dir, output_dir, classes, label_map)
+        for p in json_paths
+    ]
+
+
+@traced('convert')
+def convert_labelme_to_yolo(labelme_dir, output_dir, classes, label_map=existing_labels,
+                            files=None, workers=None, chunksize=64):
+    os.makedirs(output_dir, exist_ok=True)
+
+    if files is None:
+        files = sorted(
+            os.path.join(labelme_dir, e.name)
+            for e in os.scandir(labelme_dir)
+            if e.name.endswith('.json') and not e.name.endswith('.meta.json')
+        )
+
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    chunks = [files[i:i + chunksize] for i in range(0, len(files), chunksize)]
+
+    results = []
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            results.extend(_convert_chunk(chunk, labelme_dir, output_dir, classes, label_map))
+    else:
+        n = len(chunks)
+        with ProcessPoolExecutor(max_workers=min(workers, n)) as pool:
+            for chunk_results in pool.map(
+                _convert_chunk, chunks, [labelme_dir] * n, [output_dir] * n,
+                [classes] * n, [label_map] * n,
+            ):
+                results.extend(chunk_results)
+
+    elapsed = time.perf_counter() - start
+    n_boxes = sum(r[3] for r in results)
+    rate = len(results) / elapsed if elapsed > 0 else float('inf')
+    print(f'Converted {len(results)} files ({n_boxes} boxes) in {elapsed:.2f}s '
+          f'({rate:.1f} files/sec)')
+    return results
+
+
+# %%
+
+# Incremental conversion
+# The manifest remembers what every label file was built from, so a re-run
+# only converts new or edited LabelMe files.
+incremental = True
+MANIFEST_VERSION = 1
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_stat(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(manifest, manifest_path):
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+@traced('convert.incremental')
+def convert_incremental(labelme_dir, output_dir, classes, label_map=existing_labels,
+                        manifest_path=None, workers=None):
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(output_dir, 'manifest.json')
+
+    manifest = load_manifest(manifest_path)
+    # A different class order or label correction changes every file
+    if (
+        manifest is None
+        or manifest['classes'] != list(classes)
+        or manifest['label_map'] != dict(label_map)
+    ):
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'classes': list(classes),
+            'label_map': dict(label_map),
+            'files': {},
+        }
+    entries = manifest['files']
+
+    sources = {
+        e.name: os.path.join(labelme_dir, e.name)
+        for e in os.scandir(labelme_dir)
+        if e.name.endswith('.json') and not e.name.endswith('.meta.json')
+    }
+
+    # Drop outputs whose LabelMe source is gone. Scanning the directory (not
+    # just the manifest) also catches files left from before a manifest reset.
+    for name in [name for name in entries if name not in sources]:
+        entries.pop(name)
+    removed = [
+        e.path for e in os.scandir(output_dir)
+        if e.name.endswith('.txt') and e.name[:-len('.txt')] + '.json' not in sources
+    ]
+    for output in removed:
+        os.remove(output)
+
+    to_convert = []
+    digests = {}
+    stats = {}
+    for name, json_path in sorted(sources.items()):
+        entry = entries.get(name)
+        # Taken before converting, so an edit made during this run is
+        # picked up by the next one
+        stat = stats[name] = file_stat(json_path)
+        if entry is not None and os.path.exists(os.path.join(output_dir, entry['output'])):
+            image_ok = file_stat(entry['image']) == entry['image_stat']
+            if image_ok and entry['stat'] == stat:
+                continue
+            # Touched but not edited, e.g. re-saved without changes
+            digest = file_digest(json_path)
+            if image_ok and entry['sha1'] == digest:
+                entry['stat'] = stat
+                continue
+            digests[name] = digest
+        if name not in digests:
+            digests[name] = file_digest(json_path)
+        to_convert.append(json_path)
+
+    results = []
+    if to_convert:
+        results = convert_labelme_to_yolo(
+            labelme_dir, output_dir, classes, label_map, files=to_convert, workers=workers
+        )
+
+    for json_path, (yolo_file, img_path, img_size, _) in zip(to_convert, results):
+        name = os.path.basename(json_path)
+        entries[name] = {
+            'sha1': digests[name],
+            'stat': stats[name],
+            'image': str(img_path),
+            'image_stat': file_stat(img_path),
+            'image_size': list(img_size),
+            'output': os.path.basename(yolo_file),
+        }
+
+    save_manifest(manifest, manifest_path)
+    elapsed = time.perf_counter() - start
+    print(f'Incremental conversion: {len(to_convert)} converted, '
+          f'{len(sources) - len(to_convert)} up to date, {len(removed)} removed '
+          f'in {elapsed:.2f}s')
+    return manifest
+
+
+if __name__ == '__main__':
+    if incremental:
+        convert_incremental(labelme_path, output_dir, classes)
+    else:
+        convert_labelme_to_yolo(labelme_path, output_dir, classes)
+
+    # Keep the consolidated label store in step with yolo_annotations
+    from label_store import build_label_store
+
+    build_label_store(output_dir)
+
+    print(set(labels))
 
 # %%
 
@@ -89,45 +325,216 @@ print(set(labels))
 import os
 import random
 import shutil
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# How files are materialized in the dataset tree:
+# copy     - byte copy on a thread pool
+# hardlink - os.link, falls back to copy across filesystems
+# symlink  - absolute symlinks to the sources
+# reflink  - copy-on-write clone (btrfs, xfs, ...), falls back to copy
+# manifest - no image files at all, writes YOLO train.txt/val.txt lists and
+#            a data.yml that points at them. Ultralytics finds labels next to
+#            the listed images, so this also writes .txt label files into the
+#            image directory (Annotations/ by default).
+# Labels are always copied (or reflinked): they are tiny, and a hardlink or
+# symlink would let a later reconversion change the labels of a frozen split.
+split_modes = ('copy', 'hardlink', 'symlink', 'reflink', 'manifest')
+split_mode = 'hardlink'
+
+# Near-duplicate handling before the split (see dedup.py):
+# None  - every image is split on its own
+# group - each cluster of near-duplicates goes to a single split
+# drop  - only the image with most boxes of each cluster is kept
+dedup_modes = (None, 'group', 'drop')
+dedup_mode = 'group'
+dedup_threshold = 4
+dedup_cache = Path('dedup_hashes.json')
+
+FICLONE = 0x40049409
+
+
+def reflink_file(source, dest):
+    import fcntl
 
-def split_dataset(image_dir, labels_dir, destination_dir, split_ratio=0.8):
-    # Create destination directories
-    os.makedirs(os.path.join(destination_dir, 'images', 'train'), exist_ok=True)
-    os.makedirs(os.path.join(destination_dir, 'images', 'val'), exist_ok=True)
-    os.makedirs(os.path.join(destination_dir, 'labels', 'train'), exist_ok=True)
-    os.makedirs(os.path.join(destination_dir, 'labels', 'val'), exist_ok=True)
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def materialize(source, dest, mode='copy'):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        if mode == 'hardlink':
+            os.link(source, dest)
+            return
+        if mode == 'symlink':
+            os.symlink(os.path.abspath(source), dest)
+            return
+        if mode == 'reflink':
+            reflink_file(source, dest)
+            return
+    except (OSError, ImportError):
+        # Cross-device link or no reflink support on this filesystem
+        if os.path.lexists(dest):
+            os.remove(dest)
+    shutil.copyfile(source, dest)
+
+
+def read_label_classes(label_file):
+    try:
+        with open(label_file, 'r') as f:
+            return {int(line.split(maxsplit=1)[0]) for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def group_units(image_files, groups=None):
+    # Images that must land in the same split, in a deterministic order
+    units = {}
+    for f in sorted(image_files):
+        units.setdefault(groups[f] if groups else f, []).append(f)
+    return list(units.values())
+
+
+def stratified_split(image_files, labels_dir, split_ratio=0.8, seed=0, groups=None):
+    image_classes = {
+        f: read_label_classes(os.path.join(labels_dir, os.path.splitext(f)[0] + '.txt'))
+        for f in image_files
+    }
+    class_counts = Counter(c for cs in image_classes.values() for c in cs)
+
+    # Stratify on the rarest class in each image (or near-duplicate group)
+    # so the few Reactors images are spread over both splits; unlabeled
+    # images form their own stratum.
+    strata = {}
+    for unit in group_units(image_files, groups):
+        cs = set().union(*(image_classes[f] for f in unit))
+        key = min(cs, key=lambda c: (class_counts[c], c)) if cs else -1
+        strata.setdefault(key, []).append(unit)
+
+    rng = random.Random(seed)
+    train, val = [], []
+    for key in sorted(strata):
+        units = strata[key]
+        rng.shuffle(units)
+        split_index = int(round(len(units) * split_ratio))
+        train.extend(f for unit in units[:split_index] for f in unit)
+        val.extend(f for unit in units[split_index:] for f in unit)
+    return train, val
+
+
+def clear_split_dirs(destination_dir):
+    for kind in ('images', 'labels'):
+        for split in ('train', 'val'):
+            split_dir = os.path.join(destination_dir, kind, split)
+            os.makedirs(split_dir, exist_ok=True)
+            for entry in os.scandir(split_dir):
+                if entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                    os.remove(entry.path)
+
+
+def write_manifest_data_yml(destination_dir):
+    # data.yml for manifest mode; the project data.yml points at
+    # dataset/images/*, which manifest mode leaves empty
+    with open(Path(__file__).resolve().parent / 'data.yml', 'r') as f:
+        data = yaml.safe_load(f)
+    data['path'] = os.path.abspath(destination_dir)
+    data['train'], data['val'] = 'train.txt', 'val.txt'
+    yml_path = os.path.join(destination_dir, 'data.yml')
+    with open(yml_path, 'w') as f:
+        yaml.safe_dump(data, f, sort_keys=False)
+    print(f'Manifest split: train with data={yml_path}')
+    return yml_path
+
+
+@traced('split')
+def split_dataset(image_dir, labels_dir, destination_dir, split_ratio=0.8,
+                  mode=split_mode, seed=0, stratify=True, workers=16, dedup=dedup_mode,
+                  threshold=dedup_threshold, hash_cache=dedup_cache):
+    if mode not in split_modes:
+        raise ValueError(f'Unknown split mode: {mode}, expected one of {split_modes}')
+    if dedup not in dedup_modes:
+        raise ValueError(f'Unknown dedup mode: {dedup}, expected one of {dedup_modes}')
+    start = time.perf_counter()
 
     # Get all image files
-    image_files = [f for f in os.listdir(image_dir) if f.endswith(('.jpg', '.jpeg', '.png'))]
-    
-    # Shuffle the list of image files
-    random.shuffle(image_files)
-
-    # Calculate split index
-    split_index = int(len(image_files) * split_ratio)
-
-    # Split and copy files
-    for i, image_file in enumerate(image_files):
-        source_image = os.path.join(image_dir, image_file)
-        source_label = os.path.join(
-            labels_dir, os.path.splitext(image_file)[0] + ".txt"
-        )
+    image_files = sorted(f for f in os.listdir(image_dir) if f.endswith(('.jpg', '.jpeg', '.png', '.webp')))
+
+    groups = None
+    if dedup:
+        from dedup import find_duplicates, keep_one_per_group
+
+        with span('split.dedup'):
+            groups = find_duplicates(image_dir, image_files, threshold, cache_path=hash_cache)
+        if dedup == 'drop':
+            image_files = keep_one_per_group(image_files, groups, labels_dir)
+            groups = None
+
+    if stratify:
+        train, val = stratified_split(image_files, labels_dir, split_ratio, seed, groups)
+    else:
+        units = group_units(image_files, groups)
+        random.Random(seed).shuffle(units)
+        split_index = int(len(units) * split_ratio)
+        train = [f for unit in units[:split_index] for f in unit]
+        val = [f for unit in units[split_index:] for f in unit]
+
+    os.makedirs(destination_dir, exist_ok=True)
+    label_mode = 'reflink' if mode == 'reflink' else 'copy'
+    tasks = []
+    if mode == 'manifest':
+        # Only the image lists are written. Ultralytics looks for the label
+        # of each listed image at yolo_label_path, so the (small) label files
+        # are placed there.
+        for split, files in (('train', train), ('val', val)):
+            with open(os.path.join(destination_dir, f'{split}.txt'), 'w') as f:
+                f.writelines(os.path.abspath(os.path.join(image_dir, i)) + '\n' for i in files)
+        for image_file in image_files:
+            source_label = os.path.join(labels_dir, os.path.splitext(image_file)[0] + '.txt')
+            dest_label = yolo_label_path(os.path.join(image_dir, image_file))
+            if os.path.exists(source_label) and os.path.abspath(source_label) != os.path.abspath(dest_label):
+                tasks.append((source_label, dest_label, 'copy'))
+        write_manifest_data_yml(destination_dir)
+    else:
+        # Stale files from a previous split would leak between train and val
+        clear_split_dirs(destination_dir)
+        # Readers take a manifest list over images/<split> (see
+        # yolo_paths.split_image_paths), so drop one left by a manifest split
+        for split in ('train', 'val'):
+            list_path = os.path.join(destination_dir, f'{split}.txt')
+            if os.path.exists(list_path):
+                os.remove(list_path)
+        for split, files in (('train', train), ('val', val)):
+            for image_file in files:
+                stem = os.path.splitext(image_file)[0]
+                tasks.append((
+                    os.path.join(image_dir, image_file),
+                    os.path.join(destination_dir, 'images', split, image_file),
+                    mode,
+                ))
+                source_label = os.path.join(labels_dir, stem + '.txt')
+                if os.path.exists(source_label):
+                    tasks.append((
+                        source_label,
+                        os.path.join(destination_dir, 'labels', split, stem + '.txt'),
+                        label_mode,
+                    ))
 
-        if i < split_index:  # Train set
-            dest_image = os.path.join(destination_dir, 'images', 'train', image_file)
-            dest_label = os.path.join(destination_dir, 'labels', 'train', os.path.splitext(image_file)[0] + '.txt')
-        else:  # Validation set
-            dest_image = os.path.join(destination_dir, 'images', 'val', image_file)
-            dest_label = os.path.join(destination_dir, 'labels', 'val', os.path.splitext(image_file)[0] + '.txt')
+    with span('split.materialize', mode=mode, files=len(tasks)), \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda t: materialize(*t), tasks))
 
-        shutil.copy(source_image, dest_image)
-        if os.path.exists(source_label):
-            shutil.copy(source_label, dest_label)         
+    elapsed = time.perf_counter() - start
+    print(f'Split {len(image_files)} images into {len(train)} train / {len(val)} val '
+          f'({mode}, seed={seed}) in {elapsed:.2f}s')
+    return train, val
 
 
-image_dir = labelme_path
-labels_dir = output_dir
-destination_dir = Path('dataset')
+if __name__ == '__main__':
+    image_dir = labelme_path
+    labels_dir = output_dir
+    destination_dir = Path('dataset')
 
-split_dataset(image_dir, labels_dir, destination_dir)
+    split_dataset(image_dir, labels_dir, destination_dir)
 # %%
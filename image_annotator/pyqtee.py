@@ -2,10 +2,30 @@ import sys
 import os
 import json
 import subprocess
-import geopandas as gpd
-
-from PyQt5.QtCore import QUrl, QPoint, Qt, QRect, QTemporaryFile
-from PyQt5.QtGui import QPixmap, QPainter, QPen, QColor
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from network_lod import NetworkLOD
+from substation_index import ALL_TYPES, SubstationIndex
+from widgets import CropLabel, scale_and_pad
+
+from PyQt5.QtCore import (
+    QUrl,
+    Qt,
+    QRect,
+    QTemporaryFile,
+    QThread,
+    QTimer,
+    QBuffer,
+    QByteArray,
+    QObject,
+    QRunnable,
+    QThreadPool,
+    pyqtSignal,
+    pyqtSlot,
+)
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -26,102 +46,221 @@ from PyQt5.QtWidgets import (
 # For web content, we'll use QtWebEngineWidgets if available
 try:
     from PyQt5.QtWebEngineWidgets import QWebEngineView
+    from PyQt5.QtWebEngineCore import QWebEngineUrlScheme, QWebEngineUrlSchemeHandler
+    from PyQt5.QtWebChannel import QWebChannel
 except ImportError as e:
     print("QtWebEngineWidgets not available. Web content features will be disabled.", e)
     QWebEngineView = None
+    QWebChannel = None
+    QWebEngineUrlSchemeHandler = object
 
 # For loading the Google Maps API
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Imported after load_dotenv so trace_file can be set in .env
+import tracing
+
 api_key = os.getenv("api_key")
 
-# Load the data
-unique_substations_gdf = gpd.read_file("substations_filtered.geojson")
-unique_substations_gdf["SS_ID"] = unique_substations_gdf["substation"]
+# Optional XYZ tile source ({z}/{x}/{y} template). When set, the map draws
+# its imagery through the local tile cache and tiles of the next
+# substations are prefetched while the current one is annotated.
+tile_url = os.getenv("tile_url")
+tile_cache_mb = int(os.getenv("tile_cache_mb", "2048"))
+prefetch_ahead = int(os.getenv("prefetch_ahead", "5"))
+TILE_SCHEME = b"tiles"
+
+# Screenshot encoding: "png" (zlib level 0-9) or "webp" (quality 100 is lossless)
+capture_format = os.getenv("capture_format", "png").lower()
+capture_png_level = int(os.getenv("capture_png_level", "1"))
+capture_webp_quality = int(os.getenv("capture_webp_quality", "100"))
+
+# Pre-labeling of new captures with a warm detector (see prelabel.py)
+prelabel_weights = os.getenv("prelabel_weights")
+prelabel_timeout_ms = int(os.getenv("prelabel_timeout_ms", "500"))
+
+# "labelme" (default): one LabelMe process per capture; "session" (opt-in):
+# captures go to the watched work queue and are annotated in one
+# long-lived window (see annotation_session.py)
+annotation_mode = os.getenv("annotation_mode", "labelme").lower()
+
+# The GeoJSON is loaded on a worker thread (see GeodataLoader) from the
+# GeoParquet snapshots in geodata_cache, so the window shows immediately.
+
+
+# Half a pixel at zoom 18 (~0.3 m); simplifying below that is invisible
+LINE_SIMPLIFY_TOLERANCE = 360 / (256 * 2**18) / 2
+LINE_CACHE_SIZE = 4096
+
+
+def build_line_index(tl_gdf):
+    # SS_ID -> positions of the lines that start or end at it, built once
+    positions = np.arange(len(tl_gdf))
+    ss_ids = np.concatenate(
+        [tl_gdf["substation_a"].to_numpy(), tl_gdf["substation_b"].to_numpy()]
+    )
+    line_pos = np.concatenate([positions, positions])
+    order = np.argsort(ss_ids, kind="stable")
+    ss_ids, line_pos = ss_ids[order], line_pos[order]
+    keys, starts = np.unique(ss_ids, return_index=True)
+    return {
+        key: np.unique(group).tolist()
+        for key, group in zip(keys.tolist(), np.split(line_pos, starts[1:]))
+    }
+
+
+class TileSchemeHandler(QWebEngineUrlSchemeHandler):
+    # Serves tiles://z/x/y from the tile cache. On a miss the page is sent
+    # to the tile source directly and the tile is cached in the background.
+    def __init__(self, tile_cache, prefetcher, parent=None):
+        super().__init__(parent)
+        self.tile_cache = tile_cache
+        self.prefetcher = prefetcher
+        self.buffers = []
+
+    def requestStarted(self, job):
+        try:
+            z, x, y = (int(p) for p in job.requestUrl().path().strip("/").split("/")[-3:])
+        except ValueError:
+            job.fail(job.UrlInvalid)
+            return
 
-# Make sure the CRS is set to EPSG:4326
-unique_substations_gdf = unique_substations_gdf.to_crs(epsg=4326)
+        data = self.tile_cache.get(z, x, y)
+        if data is None:
+            self.prefetcher.pool.submit(self.prefetcher.fetch, (z, x, y), self.prefetcher.generation)
+            job.redirect(QUrl(self.tile_cache.source.url(z, x, y)))
+            return
 
-# Create lat and lon from geom points
-unique_substations_gdf["lat"] = unique_substations_gdf.geometry.y
-unique_substations_gdf["lon"] = unique_substations_gdf.geometry.x
+        buffer = QBuffer(parent=job)
+        buffer.setData(QByteArray(data))
+        buffer.open(QBuffer.ReadOnly)
+        job.reply(b"image/png" if data[:4] == b"\x89PNG" else b"image/jpeg", buffer)
 
-# Transmission lines
-transmission_lines_gdf = gpd.read_file("split_lines_filtered.geojson")
 
-# Make sure crs is set to EPSG:4326
-transmission_lines_gdf = transmission_lines_gdf.to_crs(epsg=4326)
+def register_tile_scheme():
+    # Custom schemes have to be registered before the QApplication exists
+    scheme = QWebEngineUrlScheme(TILE_SCHEME)
+    scheme.setSyntax(QWebEngineUrlScheme.Syntax.Path)
+    scheme.setFlags(
+        QWebEngineUrlScheme.SecureScheme
+        | QWebEngineUrlScheme.LocalAccessAllowed
+        | QWebEngineUrlScheme.CorsEnabled
+    )
+    QWebEngineUrlScheme.registerScheme(scheme)
 
 
-class CropLabel(QLabel):
-    def __init__(self, pixmap, parent=None):
-        super().__init__(parent)
-        self.setPixmap(pixmap)
-        self.start_point = QPoint()
-        self.end_point = QPoint()
-        self.drawing = False
-
-    def mousePressEvent(self, event):
-        if event.button() == Qt.LeftButton:
-            self.start_point = event.pos()
-            self.end_point = event.pos()
-            self.drawing = True
-            self.update()
-
-    def mouseMoveEvent(self, event):
-        if self.drawing:
-            self.end_point = event.pos()
-            self.update()
-
-    def mouseReleaseEvent(self, event):
-        if event.button() == Qt.LeftButton:
-            self.end_point = event.pos()
-            self.drawing = False
-            self.update()
-
-    def paintEvent(self, event):
-        super().paintEvent(event)
-        if not self.start_point.isNull() and not self.end_point.isNull():
-            painter = QPainter(self)
-            painter.setPen(QPen(Qt.red, 2, Qt.DashLine))
-            painter.drawRect(QRect(self.start_point, self.end_point))
-
-    def get_cropped_pixmap(self, target_size=(1280, 1280)):
-        x = min(self.start_point.x(), self.end_point.x())
-        y = min(self.start_point.y(), self.end_point.y())
-        width = abs(self.start_point.x() - self.end_point.x())
-        height = abs(self.start_point.y() - self.end_point.y())
-
-        # Crop the pixmap
-        cropped_pixmap = self.pixmap().copy(x, y, width, height)
-
-        # Resize the cropped pixmap
-        resized_pixmap = cropped_pixmap.scaled(
-            target_size[0], target_size[1], Qt.KeepAspectRatio, Qt.SmoothTransformation
-        )
+class NetworkBridge(QObject):
+    # Exposed to the page over QWebChannel as `bridge`
+    viewport = pyqtSignal(int, float, float, float, float, float)
 
-        # If the resized pixmap is smaller than the target size, pad it
-        if (
-            resized_pixmap.width() != target_size[0]
-            or resized_pixmap.height() != target_size[1]
-        ):
-            padded_pixmap = QPixmap(target_size[0], target_size[1])
-            padded_pixmap.fill(Qt.black)  # Fill with black, you can change this color
+    @pyqtSlot(int, float, float, float, float, float)
+    def viewportChanged(self, seq, west, south, east, north, zoom):
+        self.viewport.emit(seq, west, south, east, north, zoom)
 
-            # Calculate position to center the resized image
-            x_offset = (target_size[0] - resized_pixmap.width()) // 2
-            y_offset = (target_size[1] - resized_pixmap.height()) // 2
 
-            # Draw the resized image onto the padded pixmap
-            painter = QPainter(padded_pixmap)
-            painter.drawPixmap(x_offset, y_offset, resized_pixmap)
-            painter.end()
+class GeodataLoader(QThread):
+    loaded = pyqtSignal(object, object, object, object, object)
+    failed = pyqtSignal(str)
 
-            return padded_pixmap
+    def run(self):
+        try:
+            from geodata_cache import load_geodata
+
+            with tracing.span("geodata.load"):
+                gdf, tl_gdf = load_geodata()
+            with tracing.span("geodata.index"):
+                line_index, index = build_line_index(tl_gdf), SubstationIndex(gdf)
+            with tracing.span("network.build"):
+                network = NetworkLOD(tl_gdf)
+            self.loaded.emit(gdf, tl_gdf, line_index, index, network)
+        except Exception as e:
+            self.failed.emit(str(e))
 
-        return resized_pixmap
+
+def capture_rect(image, crop_rect):
+    # A click without a drag (or a zero-width drag) captures the whole view
+    if crop_rect is None or crop_rect.isEmpty():
+        return QRect(0, 0, image.width(), image.height())
+    return crop_rect
+
+
+def capture_metadata(lat, lon, zoom, heading, tilt, image, crop_rect, target_size=(1280, 1280)):
+    # Everything needed to map chip pixels back to lon/lat (see georeference.py):
+    # chip pixel = (view pixel - crop origin) * scale + offset
+    crop_rect = capture_rect(image, crop_rect)
+    scale = min(target_size[0] / crop_rect.width(), target_size[1] / crop_rect.height())
+    return {
+        "lat": float(lat),
+        "lon": float(lon),
+        "zoom": float(zoom),
+        "heading": float(heading),
+        "tilt": float(tilt),
+        "view_size": [image.width(), image.height()],
+        "device_pixel_ratio": image.devicePixelRatio(),
+        "crop": [crop_rect.x(), crop_rect.y(), crop_rect.width(), crop_rect.height()],
+        "scale": scale,
+        "offset": [
+            (target_size[0] - round(crop_rect.width() * scale)) // 2,
+            (target_size[1] - round(crop_rect.height() * scale)) // 2,
+        ],
+        "captured_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def sidecar_path(image_path):
+    return os.path.splitext(image_path)[0] + ".meta.json"
+
+
+def write_sidecar(image_path, metadata):
+    path = sidecar_path(image_path)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(metadata, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+def encode_options(fmt=capture_format):
+    if fmt == "webp":
+        return "webp", b"WEBP", capture_webp_quality
+    # Qt maps quality q to zlib level (100 - q) * 9 / 91
+    return "png", b"PNG", round(100 - capture_png_level * 91 / 9)
+
+
+class CaptureSignals(QObject):
+    finished = pyqtSignal(str, object)
+    failed = pyqtSignal(str)
+
+
+class CaptureJob(QRunnable):
+    # Crop, scale/pad and encode a screenshot on the capture pool
+    def __init__(self, image, crop_rect, file_stem, target_size=(1280, 1280)):
+        super().__init__()
+        self.image = image
+        self.crop_rect = crop_rect
+        self.file_stem = file_stem
+        self.target_size = target_size
+        self.signals = CaptureSignals()
+
+    def run(self):
+        try:
+            timings = {}
+            start = time.perf_counter()
+            with tracing.span("capture.scale"):
+                cropped = self.image.copy(capture_rect(self.image, self.crop_rect))
+                chip = scale_and_pad(cropped, self.target_size)
+            timings["scale"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            ext, fmt, quality = encode_options()
+            path = f"{self.file_stem}.{ext}"
+            with tracing.span("capture.encode", format=ext):
+                if not chip.save(path, fmt, quality):
+                    raise IOError(f"Could not save {path}")
+            timings["encode"] = time.perf_counter() - start
+            self.signals.finished.emit(path, timings)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
 
 
 class ScreenshotPreviewDialog(QDialog):
@@ -153,16 +292,79 @@ class ScreenshotPreviewDialog(QDialog):
 
 
 class SubstationMapApp(QMainWindow):
+    prelabel_done = pyqtSignal(str, object, float, object)
+
     def __init__(self, gdf, tl_gdf, api_key):
         super().__init__()
-        self.gdf = gdf
-        self.tl_gdf = tl_gdf
+        self.gdf = None
+        self.tl_gdf = None
         self.api_key = api_key
         self.current_index = 0
-        self.filtered_gdf = self.gdf
-        self.ss_type = "All Types"
+        self.index = None
+        self.positions = np.arange(0)
+        self.visited = set()
+        self.ss_type = ALL_TYPES
         self.show_transmission_lines = False
+        self.show_network = False
+        self.network = None
+        self.page_ready = False
+        self.line_index = {}
+        self.line_json = lru_cache(maxsize=LINE_CACHE_SIZE)(self.serialize_line)
+
+        # Captures are encoded in the background, one at a time in order
+        self.capture_pool = QThreadPool(self)
+        self.capture_pool.setMaxThreadCount(1)
+        self.prelabeler = None
+        self.pending_captures = set()
+        self.session = None
+        self.prelabel_done.connect(self.on_prelabel_done)
+
+        self.tile_cache = None
+        self.prefetcher = None
+        if tile_url:
+            from tile_cache import TileCache, TilePrefetcher, TileSource
+
+            self.tile_cache = TileCache(TileSource(tile_url), max_bytes=tile_cache_mb << 20)
+            self.prefetcher = TilePrefetcher(self.tile_cache)
         self.initUI()
+        if gdf is not None:
+            self.set_data(gdf, tl_gdf)
+
+    def load_data_async(self):
+        self.status_label.setText("Loading substations and transmission lines...")
+        self.loader = GeodataLoader(self)
+        self.loader.loaded.connect(self.set_data)
+        self.loader.failed.connect(
+            lambda e: self.status_label.setText(f"Error loading geodata: {e}")
+        )
+        self.loader.start()
+
+    def set_data(self, gdf, tl_gdf, line_index=None, index=None, network=None):
+        self.gdf = gdf
+        self.tl_gdf = tl_gdf
+        self.line_index = line_index if line_index is not None else build_line_index(tl_gdf)
+        self.network = network if network is not None else NetworkLOD(tl_gdf)
+        self.line_json.cache_clear()
+        self.index = index if index is not None else SubstationIndex(gdf)
+        self.visited = set()
+
+        self.ss_type_dropdown.blockSignals(True)
+        self.ss_type_dropdown.clear()
+        self.ss_type_dropdown.addItem(ALL_TYPES)
+        self.ss_type_dropdown.addItems(sorted(self.gdf["SS_TYPE"].unique()))
+        self.ss_type_dropdown.blockSignals(False)
+
+        self.ss_type = ALL_TYPES
+        self.update_filter()
+        self.status_label.setText(f"Loaded {len(self.gdf)} substations.")
+        if self.page_ready:
+            self.update_display()
+
+    def on_page_loaded(self, ok):
+        tracing.complete("map.page_load", self.page_load_start)
+        self.page_ready = ok
+        if ok and self.gdf is not None:
+            self.update_display()
 
     def initUI(self):
         self.setWindowTitle("Substation Viewer with LabelMe Integration")
@@ -172,6 +374,18 @@ class SubstationMapApp(QMainWindow):
 
         # Web view
         self.web_view = QWebEngineView()
+        self.web_view.loadFinished.connect(self.on_page_loaded)
+        # The page reports its viewport for the network overlay
+        self.bridge = NetworkBridge(self)
+        self.bridge.viewport.connect(self.on_viewport)
+        self.channel = QWebChannel(self.web_view.page())
+        self.channel.registerObject("bridge", self.bridge)
+        self.web_view.page().setWebChannel(self.channel)
+        if self.tile_cache is not None:
+            self.tile_handler = TileSchemeHandler(self.tile_cache, self.prefetcher, self)
+            self.web_view.page().profile().installUrlSchemeHandler(
+                TILE_SCHEME, self.tile_handler
+            )
         layout.addWidget(self.web_view, stretch=1)
 
         # Search layout
@@ -186,8 +400,7 @@ class SubstationMapApp(QMainWindow):
 
         # SS_TYPE filter dropdown
         self.ss_type_dropdown = QComboBox()
-        self.ss_type_dropdown.addItem("All Types")
-        self.ss_type_dropdown.addItems(sorted(self.gdf["SS_TYPE"].unique()))
+        self.ss_type_dropdown.addItem(ALL_TYPES)
         self.ss_type_dropdown.currentTextChanged.connect(self.on_ss_type_changed)
         search_layout.addWidget(self.ss_type_dropdown)
 
@@ -199,6 +412,14 @@ class SubstationMapApp(QMainWindow):
         self.next_button.clicked.connect(self.next_substation)
         button_layout.addWidget(self.next_button)
 
+        self.proximity_button = QPushButton("Next by Proximity")
+        self.proximity_button.clicked.connect(self.next_by_proximity)
+        button_layout.addWidget(self.proximity_button)
+
+        self.unannotated_button = QPushButton("Nearest Unannotated")
+        self.unannotated_button.clicked.connect(self.nearest_unannotated)
+        button_layout.addWidget(self.unannotated_button)
+
         self.preview_button = QPushButton("Preview and Annotate")
         self.preview_button.clicked.connect(self.preview_and_annotate)
         button_layout.addWidget(self.preview_button)
@@ -208,6 +429,11 @@ class SubstationMapApp(QMainWindow):
         self.show_lines_checkbox.stateChanged.connect(self.toggle_transmission_lines)
         button_layout.addWidget(self.show_lines_checkbox)
 
+        # Whole network around the viewport
+        self.show_network_checkbox = QCheckBox("Show Network")
+        self.show_network_checkbox.stateChanged.connect(self.toggle_network)
+        button_layout.addWidget(self.show_network_checkbox)
+
         layout.addLayout(button_layout)
 
         self.status_label = QLabel(
@@ -227,7 +453,8 @@ class SubstationMapApp(QMainWindow):
         <html>
         <head>
             <title>Google Maps</title>
-            <script src="https://maps.googleapis.com/maps/api/js?key={self.api_key}"></script>
+            <script src="https://maps.googleapis.com/maps/api/js?key={self.api_key}&libraries=geometry"></script>
+            <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
             <style>
                 #map {{
                     height: 100%;
@@ -261,6 +488,26 @@ class SubstationMapApp(QMainWindow):
             <script>
                 var map;
                 var transmissionLines = [];
+                var bridge = null;
+                var networkEnabled = false;
+                var networkSeq = 0;
+                var networkLines = [];
+                new QWebChannel(qt.webChannelTransport, channel => {{
+                    bridge = channel.objects.bridge;
+                }});
+                const useTileCache = {"true" if self.tile_cache is not None else "false"};
+
+                // The map is built once; navigation only recenters it
+                function showLocation(lat, lng) {{
+                    if (!map) {{
+                        initMap(lat, lng);
+                        return;
+                    }}
+                    map.setCenter({{ lat: lat, lng: lng }});
+                    map.setZoom(18);
+                    map.setHeading(0);
+                    map.setTilt(0);
+                }}
 
                 function initMap(lat, lng) {{
                     map = new google.maps.Map(document.getElementById("map"), {{
@@ -272,6 +519,23 @@ class SubstationMapApp(QMainWindow):
                         mapTypeId: 'satellite'
                     }});
 
+                    if (useTileCache) {{
+                        map.mapTypes.set("cached", new google.maps.ImageMapType({{
+                            getTileUrl: (coord, zoom) => {{
+                                const n = 1 << zoom;
+                                const x = ((coord.x % n) + n) % n;
+                                return `tiles://tile/${{zoom}}/${{x}}/${{coord.y}}`;
+                            }},
+                            tileSize: new google.maps.Size(256, 256),
+                            maxZoom: 21,
+                            name: "Cached",
+                        }}));
+                        map.setMapTypeId("cached");
+                    }}
+
+                    // Fires once panning/zooming settles
+                    map.addListener("idle", reportViewport);
+
                     const buttons = [
                         ["Rotate Left", "rotate", 20, google.maps.ControlPosition.LEFT_CENTER],
                         ["Rotate Right", "rotate", -20, google.maps.ControlPosition.RIGHT_CENTER],
@@ -320,6 +584,42 @@ class SubstationMapApp(QMainWindow):
                     }});
                 }}
 
+                function reportViewport() {{
+                    if (!networkEnabled || !bridge || !map || !map.getBounds()) return;
+                    const bounds = map.getBounds();
+                    const sw = bounds.getSouthWest(), ne = bounds.getNorthEast();
+                    bridge.viewportChanged(++networkSeq, sw.lng(), sw.lat(), ne.lng(), ne.lat(),
+                                           map.getZoom());
+                }}
+
+                function setNetworkEnabled(on) {{
+                    networkEnabled = on;
+                    if (on) reportViewport();
+                    else drawNetwork(networkSeq, []);
+                }}
+
+                function drawNetwork(seq, encoded) {{
+                    // Answers to an older viewport are dropped
+                    if (seq !== networkSeq) return;
+                    const decodePath = google.maps.geometry.encoding.decodePath;
+                    // Polylines are pooled; moving the viewport only swaps paths
+                    encoded.forEach((path, i) => {{
+                        if (i >= networkLines.length) {{
+                            networkLines.push(new google.maps.Polyline({{
+                                strokeColor: '#FFA500',
+                                strokeOpacity: 0.9,
+                                strokeWeight: 1.5,
+                                clickable: false
+                            }}));
+                        }}
+                        networkLines[i].setPath(decodePath(path));
+                        if (!networkLines[i].getMap()) networkLines[i].setMap(map);
+                    }});
+                    for (let i = encoded.length; i < networkLines.length; i++) {{
+                        networkLines[i].setMap(null);
+                    }}
+                }}
+
                 function clearTransmissionLines() {{
                     transmissionLines.forEach(line => line.setMap(null));
                     transmissionLines = [];
@@ -328,13 +628,33 @@ class SubstationMapApp(QMainWindow):
         </body>
         </html>
         """
+        self.page_load_start = tracing.now()
         self.web_view.setHtml(html, QUrl(""))
 
+    def serialize_line(self, pos):
+        geometry = self.tl_gdf.geometry.iloc[pos].simplify(
+            LINE_SIMPLIFY_TOLERANCE, preserve_topology=False
+        )
+        coords = np.round(np.asarray(geometry.coords)[:, :2], 6)
+        return json.dumps(coords.tolist())
+
+    def lines_payload(self, ss_id):
+        positions = self.line_index.get(ss_id, [])
+        return "[" + ",".join(self.line_json(pos) for pos in positions) + "]"
+
+    @property
+    def filtered_gdf(self):
+        return self.gdf.iloc[self.positions]
+
+    def current_row(self):
+        return int(self.positions[self.current_index])
+
+    def current_substation(self):
+        return self.gdf.iloc[self.current_row()]
+
     def update_filter(self):
-        if self.ss_type == "All Types":
-            self.filtered_gdf = self.gdf
-        else:
-            self.filtered_gdf = self.gdf[self.gdf["SS_TYPE"] == self.ss_type]
+        # Precomputed positions per SS_TYPE, no filtered copy of the frame
+        self.positions = self.index.positions(self.ss_type)
         self.current_index = 0
 
     def on_ss_type_changed(self, new_ss_type):
@@ -343,9 +663,11 @@ class SubstationMapApp(QMainWindow):
         self.update_display()
 
     def update_display(self):
-        if len(self.filtered_gdf) > 0:
-            substation = self.filtered_gdf.iloc[self.current_index]
-            self.display_substation(substation)
+        if self.gdf is None:
+            self.status_label.setText("Still loading substations...")
+        elif len(self.positions) > 0:
+            self.visited.add(self.current_row())
+            self.display_substation(self.current_substation())
         else:
             self.status_label.setText("No substations found with the current filter.")
 
@@ -353,25 +675,74 @@ class SubstationMapApp(QMainWindow):
         self.show_transmission_lines = state == 2  # 2 is checked state
         self.update_display()
 
+    def toggle_network(self, state):
+        self.show_network = state == 2
+        self.web_view.page().runJavaScript(
+            f"setNetworkEnabled({'true' if self.show_network else 'false'});"
+        )
+
+    def on_viewport(self, seq, west, south, east, north, zoom):
+        if not self.show_network or self.network is None:
+            return
+        with tracing.span("network.query", zoom=zoom):
+            encoded, truncated = self.network.query(west, south, east, north, zoom)
+        payload = json.dumps(encoded)
+        self.web_view.page().runJavaScript(f"drawNetwork({seq}, {payload});")
+        message = f"Network: {len(encoded)} lines, {len(payload) // 1024} KB"
+        if truncated:
+            message += " (longest lines only, zoom in for more)"
+        self.statusBar().showMessage(message)
+
     def next_substation(self):
+        if self.gdf is None:
+            return
         self.current_index += 1
-        if self.current_index >= len(self.filtered_gdf):
+        if self.current_index >= len(self.positions):
             self.current_index = 0
         self.update_display()
 
+    def go_to_row(self, row):
+        self.current_index = self.index.locate(row, self.positions)
+        self.update_display()
+
+    def next_by_proximity(self):
+        # Closest substation in the current filter not shown yet
+        if self.gdf is None or len(self.positions) == 0:
+            return
+        candidates = self.index.filter_mask(self.positions)
+        candidates[list(self.visited)] = False
+        row = self.index.nearest(self.current_row(), candidates)
+        if row is None:
+            self.status_label.setText("All substations in this filter have been visited.")
+            return
+        self.go_to_row(row)
+
+    def nearest_unannotated(self):
+        if self.gdf is None or len(self.positions) == 0:
+            return
+        self.index.refresh_annotated()
+        candidates = self.index.filter_mask(self.positions) & ~self.index.annotated
+        row = self.index.nearest(self.current_row(), candidates)
+        if row is None:
+            self.status_label.setText("No unannotated substations left in this filter.")
+            return
+        self.go_to_row(row)
+
     def search_substation(self):
         ss_id = self.search_box.text().strip()
+        if self.gdf is None:
+            self.status_label.setText("Still loading substations...")
+            return
         if not ss_id:
             self.status_label.setText("Please enter a Substation ID.")
             return
 
         try:
             ss_id = int(ss_id)
-            substation = self.filtered_gdf[self.filtered_gdf["SS_ID"] == ss_id]
-            if not substation.empty:
-                self.current_index = self.filtered_gdf.index.get_loc(
-                    substation.index[0]
-                )
+            row = self.index.row_of.get(ss_id)
+            i = self.index.locate(row, self.positions) if row is not None else None
+            if i is not None:
+                self.current_index = i
                 self.update_display()
             else:
                 self.status_label.setText(
@@ -385,32 +756,67 @@ class SubstationMapApp(QMainWindow):
         latitude, longitude = substation_row.lat, substation_row.lon
 
         # Update the map view
-        js = f"initMap({latitude}, {longitude});"
-        self.web_view.page().runJavaScript(js)
+        js = f"showLocation({latitude}, {longitude});"
+        self.run_js_traced("map.showLocation", js)
+        with tracing.span("tiles.prefetch"):
+            self.prefetch_next()
 
         if self.show_transmission_lines:
-            related_lines = self.tl_gdf[
-                (self.tl_gdf["substation_a"] == ss_id)
-                | (self.tl_gdf["substation_b"] == ss_id)
-            ]
-            lines_json = (
-                related_lines["geometry"].apply(lambda x: list(x.coords)).tolist()
-            )
-            lines_str = json.dumps(lines_json)
-            self.web_view.page().runJavaScript(f"addTransmissionLines({lines_str});")
+            with tracing.span("lines.payload", ss_id=int(ss_id)):
+                lines_str = self.lines_payload(ss_id)
+            self.run_js_traced("map.addTransmissionLines", f"addTransmissionLines({lines_str});")
         else:
             self.web_view.page().runJavaScript("clearTransmissionLines();")
 
         self.status_label.setText(f"Displaying Substation ID: {ss_id}")
 
+    def run_js_traced(self, name, js):
+        # runJavaScript is asynchronous; the span ends when the page returns
+        if not tracing.enabled:
+            self.web_view.page().runJavaScript(js)
+            return
+        start = tracing.now()
+        self.web_view.page().runJavaScript(js, lambda _: tracing.complete(name, start))
+
+    def prefetch_next(self):
+        # Warm the tiles of the next substations in the current filter order
+        if self.prefetcher is None or len(self.positions) == 0:
+            return
+        ahead = [
+            self.positions[(self.current_index + i) % len(self.positions)]
+            for i in range(1, prefetch_ahead + 1)
+        ]
+        rows = self.gdf.iloc[ahead]
+        self.prefetcher.prefetch(
+            zip(rows["lat"].tolist(), rows["lon"].tolist()),
+            zoom=18,
+            width=self.web_view.width(),
+            height=self.web_view.height(),
+        )
+
     def preview_and_annotate(self):
-        # Capture the entire window, including the map
-        full_screenshot = self.grab()
+        if self.gdf is None:
+            self.status_label.setText("Still loading substations...")
+            return
+        # Capture only the map
+        start = time.perf_counter()
+        with tracing.span("capture.grab"):
+            screenshot = self.web_view.grab()
+        grab_time = time.perf_counter() - start
+
+        # The map may have been panned, zoomed or rotated since showLocation;
+        # the answer arrives while the crop dialog is open
+        map_state = {}
+        self.web_view.page().runJavaScript(
+            "map ? [map.getCenter().lat(), map.getCenter().lng(), map.getZoom(), "
+            "map.getHeading() || 0, map.getTilt() || 0] : null",
+            lambda state: map_state.update(state=state),
+        )
 
-        # Show the crop window with the full screenshot
+        # Show the crop window with the screenshot
         crop_dialog = QDialog(self)
         crop_layout = QVBoxLayout(crop_dialog)
-        crop_label = CropLabel(full_screenshot, crop_dialog)
+        crop_label = CropLabel(screenshot, crop_dialog)
         crop_layout.addWidget(crop_label)
 
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
@@ -419,29 +825,129 @@ class SubstationMapApp(QMainWindow):
         crop_layout.addWidget(button_box)
 
         if crop_dialog.exec_() == QDialog.Accepted:
-            cropped_pixmap = crop_label.get_cropped_pixmap()
-
-            ss_id = self.filtered_gdf.iloc[self.current_index].SS_ID
-            temp_file_name = f"screenshot_{ss_id}.png"
-            if cropped_pixmap.save(temp_file_name):
-                self.launch_labelme(temp_file_name)
+            substation = self.current_substation()
+            ss_id = substation.SS_ID
+            file_stem = f"screenshot_{ss_id}"
+            if annotation_mode == "session":
+                file_stem = os.path.join(self.annotation_session().work_dir, file_stem)
+            image, crop_rect = screenshot.toImage(), crop_label.get_crop_rect()
+            state = map_state.get("state")
+            if state:
+                metadata = capture_metadata(*state, image, crop_rect)
             else:
-                self.status_label.setText(
-                    "Error: Could not save cropped image for annotation."
+                # No answer from the page; showLocation's defaults
+                metadata = capture_metadata(substation.lat, substation.lon, 18, 0, 0, image,
+                                            crop_rect)
+                metadata["view_state"] = "assumed"
+            metadata.update(ss_id=int(ss_id), ss_type=str(substation.SS_TYPE),
+                            tile_source=tile_url or "google-maps-js")
+            job = CaptureJob(image, crop_rect, file_stem)
+            # Sidecar first, so it is in place before the chip is annotated
+            job.signals.finished.connect(
+                lambda path, timings: write_sidecar(
+                    path, dict(metadata, image=os.path.basename(path))
+                )
+            )
+            job.signals.finished.connect(
+                lambda path, timings: self.on_capture_saved(path, dict(timings, grab=grab_time))
+            )
+            job.signals.failed.connect(
+                lambda e: self.status_label.setText(
+                    f"Error: Could not save cropped image for annotation. {e}"
                 )
+            )
+            self.capture_pool.start(job)
+            self.status_label.setText(f"Saving capture of substation {ss_id}...")
         else:
             self.status_label.setText("Cropping cancelled. You can try again.")
 
+    def start_prelabeler(self, weights=None):
+        from prelabel import Prelabeler
+        from batch_inference import best_weights_path
+
+        weights = weights or prelabel_weights or best_weights_path
+        if not os.path.exists(weights):
+            print(f"No weights at {weights}, pre-labeling disabled.")
+            return
+        self.prelabeler = Prelabeler(weights).start()
+
+    def on_capture_saved(self, image_path, timings):
+        self.capture_timings = timings
+        self.show_capture_timings(image_path, timings)
+        if self.prelabeler is None or not self.prelabeler.ready.is_set():
+            self.open_annotator(image_path)
+            return
+
+        # The annotator opens with the predicted boxes, or empty if the detector
+        # misses the deadline
+        self.pending_captures.add(image_path)
+        start = tracing.now()
+
+        def done(json_path, elapsed, error):
+            tracing.complete("capture.prelabel", start)
+            self.prelabel_done.emit(image_path, json_path, elapsed, error)
+
+        self.prelabeler.submit(image_path, done)
+        QTimer.singleShot(prelabel_timeout_ms, lambda: self.finish_capture(image_path))
+
+    def on_prelabel_done(self, image_path, json_path, elapsed, error):
+        if error:
+            print(f"Pre-labeling {image_path} failed: {error}")
+        elif image_path in self.pending_captures:
+            self.show_capture_timings(image_path, dict(self.capture_timings, prelabel=elapsed))
+        if image_path in self.pending_captures:
+            self.finish_capture(image_path)
+        elif json_path and self.session is not None:
+            # Missed the deadline; show the boxes if nothing was drawn yet
+            self.session.reload_if_untouched(image_path)
+
+    def finish_capture(self, image_path):
+        if image_path in self.pending_captures:
+            self.pending_captures.discard(image_path)
+            self.open_annotator(image_path)
+
+    def annotation_session(self):
+        if self.session is None:
+            from annotation_session import AnnotationSession
+            from prepare_annotations import classes
+
+            self.session = AnnotationSession(classes)
+            self.session.annotated.connect(self.on_annotated)
+        return self.session
+
+    def open_annotator(self, image_path):
+        if annotation_mode == "session":
+            with tracing.span("session.enqueue"):
+                self.annotation_session().enqueue(image_path)
+            self.status_label.setText("Capture queued in the annotation session.")
+        else:
+            self.launch_labelme(image_path)
+
+    def on_annotated(self, ss_id):
+        if self.index is not None:
+            self.index.mark_annotated(ss_id)
+
+    def show_capture_timings(self, image_path, timings):
+        self.statusBar().showMessage(
+            f"{os.path.basename(image_path)}: "
+            + ", ".join(f"{k} {v * 1000:.0f} ms" for k, v in timings.items())
+        )
+
     def launch_labelme(self, image_path):
         try:
-            subprocess.Popen(["labelme", image_path])
+            with tracing.span("labelme.spawn"):
+                subprocess.Popen(["labelme", image_path])
             self.status_label.setText("LabelMe launched for annotation.")
         except Exception as e:
             self.status_label.setText(f"Error launching LabelMe: {str(e)}")
 
 
 if __name__ == "__main__":
+    if tile_url and QWebEngineView is not None:
+        register_tile_scheme()
     app = QApplication(sys.argv)
-    ex = SubstationMapApp(unique_substations_gdf, transmission_lines_gdf, api_key)
+    ex = SubstationMapApp(None, None, api_key)
     ex.show()
+    ex.load_data_async()
+    ex.start_prelabeler()
     sys.exit(app.exec_())
@@ -0,0 +1,368 @@
+# ------------------------------------------------------------------
+# Description: Packs the dataset/ split (image directories, or the
+# train.txt/val.txt lists of a manifest split) into size-bounded tar shards.
+# Every sample is two consecutive tar members, <key>.png and <key>.txt
+# (the YOLO label, empty for background chips), so a shard is read front
+# to back with one sequential stream instead of thousands of small-file
+# opens. Samples are shuffled once with a fixed seed before packing so a
+# shard is not a run of one substation. <split>.index.json lists the
+# shards and the byte offsets of every member for random access.
+# The reader shuffles shard order per epoch, streams several shards at
+# once on reader threads and mixes them through a shuffle buffer; ranks
+# and DataLoader workers each take a disjoint slice of the shards.
+#
+# python shard_export.py export --dataset dataset --out shards --max-mb 256
+# python shard_export.py bench --out shards --split train
+# python shard_export.py unpack --out shards --dest /local/dataset   # on a training node
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import io
+import json
+import os
+import queue
+import tarfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from yolo_paths import split_image_paths, yolo_label_path
+
+# torch is only needed for ShardDataset
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    IterableDataset = object
+
+    def get_worker_info():
+        return None
+
+dataset_dir = Path("dataset")
+shard_dir = Path("shards")
+BLOCK = tarfile.BLOCKSIZE
+READ_BUFFER = 1 << 20
+
+
+def index_path(out_dir, split):
+    return Path(out_dir) / f"{split}.index.json"
+
+
+def read_sample_files(image_path):
+    with open(image_path, "rb") as f:
+        image = f.read()
+    try:
+        with open(yolo_label_path(image_path), "rb") as f:
+            label = f.read()
+    except FileNotFoundError:
+        label = b""
+    return image, label
+
+
+def add_member(tar, name, data):
+    # Returns the offset of the member's data within the shard
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 0
+    tar.addfile(info, io.BytesIO(data))
+    return tar.offset - -(-len(data) // BLOCK) * BLOCK
+
+
+def export_split(split, dataset_dir=dataset_dir, out_dir=shard_dir, max_bytes=256 << 20,
+                 seed=0, workers=8):
+    paths = split_image_paths(dataset_dir, split)
+    paths = [paths[i] for i in np.random.default_rng(seed).permutation(len(paths))]
+
+    shards, samples = [], []
+    tar = tmp = None
+
+    def close_shard():
+        tar.close()
+        os.replace(tmp, Path(out_dir) / shards[-1]["name"])
+        shards[-1]["bytes"] = os.path.getsize(Path(out_dir) / shards[-1]["name"])
+
+    # Files are read ahead on threads; the tar itself is written in order
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, (image, label) in zip(paths, pool.map(read_sample_files, paths)):
+            # Two header blocks per member (more for PAX names), plus end-of-archive padding
+            size = len(image) + len(label) + 6 * BLOCK + tarfile.RECORDSIZE
+            if tar is None or (shards[-1]["count"] and tar.offset + size > max_bytes):
+                if tar is not None:
+                    close_shard()
+                shards.append({"name": f"{split}-{len(shards):05d}.tar", "count": 0})
+                tmp = Path(out_dir) / (shards[-1]["name"] + ".tmp")
+                tar = tarfile.open(tmp, "w", format=tarfile.PAX_FORMAT)
+            key, ext = os.path.splitext(os.path.basename(path))
+            image_offset = add_member(tar, key + ext, image)
+            label_offset = add_member(tar, key + ".txt", label)
+            samples.append([key + ext, len(shards) - 1, image_offset, len(image),
+                            label_offset, len(label)])
+            shards[-1]["count"] += 1
+    if tar is not None:
+        close_shard()
+
+    index = {"split": split, "seed": seed, "shards": shards,
+             "columns": ["name", "shard", "image_offset", "image_size", "label_offset",
+                         "label_size"],
+             "samples": samples}
+    tmp = index_path(out_dir, split).with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path(out_dir, split))
+    return index
+
+
+def export_dataset(dataset_dir=dataset_dir, out_dir=shard_dir, max_bytes=256 << 20, seed=0,
+                   workers=8):
+    start = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    for split in ("train", "val"):
+        index = export_split(split, dataset_dir, out_dir, max_bytes, seed, workers)
+        total = sum(s["bytes"] for s in index["shards"])
+        print(f"{split}: {len(index['samples'])} samples in {len(index['shards'])} shards, "
+              f"{total / 2**20:.1f} MB")
+    print(f"Exported to {out_dir} in {time.perf_counter() - start:.2f}s")
+
+
+def load_index(out_dir, split):
+    with open(index_path(out_dir, split), "r") as f:
+        return json.load(f)
+
+
+def decode_sample(name, image, label):
+    # -> name, BGR image, (n, 5) float32 array of class, x, y, w, h
+    im = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    rows = [line.split() for line in label.decode().splitlines() if line.strip()]
+    labels = np.array(rows, dtype=np.float32).reshape(-1, 5)
+    return name, im, labels
+
+
+def iter_shard(path, decode=True):
+    # One sequential pass over a shard; members of a sample are adjacent
+    with open(path, "rb", buffering=READ_BUFFER) as f, tarfile.open(fileobj=f, mode="r|") as tar:
+        key = image = None
+        for member in tar:
+            stem, ext = os.path.splitext(member.name)
+            data = tar.extractfile(member).read()
+            if ext == ".txt":
+                if stem == key:
+                    yield decode_sample(image[0], image[1], data) if decode else (*image, data)
+                key = image = None
+            else:
+                key, image = stem, (member.name, data)
+
+
+def shard_paths(out_dir, split, shuffle=True, seed=0, epoch=0, rank=0, world_size=1):
+    # Same shard order on every rank for a given seed/epoch, then a disjoint slice each
+    names = [s["name"] for s in load_index(out_dir, split)["shards"]]
+    if shuffle:
+        names = [names[i] for i in np.random.default_rng((seed, epoch)).permutation(len(names))]
+    return [Path(out_dir) / name for name in names[rank::world_size]]
+
+
+def stream_samples(out_dir=shard_dir, split="train", shuffle=True, seed=0, epoch=0, readers=4,
+                   buffer_size=1000, decode=True, rank=0, world_size=1, paths=None):
+    # Yields (name, image, labels); readers stream different shards concurrently
+    if paths is None:
+        paths = shard_paths(out_dir, split, shuffle, seed, epoch, rank, world_size)
+    if not paths:
+        return
+    pending = iter(paths)
+    lock = threading.Lock()
+    samples = queue.Queue(maxsize=max(buffer_size, 64))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                samples.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            while not stop.is_set():
+                with lock:
+                    path = next(pending, None)
+                if path is None:
+                    break
+                for sample in iter_shard(path, decode):
+                    if not put(sample):
+                        return
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    threads = [threading.Thread(target=reader, daemon=True)
+               for _ in range(min(readers, len(paths)))]
+    for t in threads:
+        t.start()
+
+    rng = np.random.default_rng((seed, epoch, rank))
+    buffer = []
+    running = len(threads)
+    try:
+        while running:
+            item = samples.get()
+            if item is done:
+                running -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            if not shuffle:
+                yield item
+                continue
+            # Shuffle buffer: emit a random earlier sample once it is full
+            if len(buffer) < buffer_size:
+                buffer.append(item)
+                continue
+            i = rng.integers(len(buffer))
+            buffer[i], item = item, buffer[i]
+            yield item
+        rng.shuffle(buffer)
+        yield from buffer
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+
+class ShardIndex:
+    # Random access into the shards through the offsets in the index
+    def __init__(self, out_dir=shard_dir, split="val"):
+        self.out_dir = Path(out_dir)
+        index = load_index(out_dir, split)
+        self.shards = [s["name"] for s in index["shards"]]
+        self.samples = index["samples"]
+        self.positions = {s[0]: i for i, s in enumerate(self.samples)}
+        self.fds = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def fd(self, shard):
+        if shard not in self.fds:
+            self.fds[shard] = os.open(self.out_dir / self.shards[shard], os.O_RDONLY)
+        return self.fds[shard]
+
+    def read(self, i, decode=True):
+        name, shard, image_offset, image_size, label_offset, label_size = self.samples[i]
+        fd = self.fd(shard)
+        image = os.pread(fd, image_size, image_offset)
+        label = os.pread(fd, label_size, label_offset)
+        return decode_sample(name, image, label) if decode else (name, image, label)
+
+    def get(self, name, decode=True):
+        return self.read(self.positions[name], decode)
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+
+class ShardDataset(IterableDataset):
+    # DataLoader workers split the rank's shards between them; call
+    # set_epoch() before each epoch for a new shard order. Defined at module
+    # level so spawned DataLoader workers can unpickle it.
+    def __init__(self, out_dir=shard_dir, split="train", shuffle=True, seed=0,
+                 buffer_size=1000, rank=0, world_size=1, transform=None):
+        self.out_dir, self.split, self.shuffle, self.seed = out_dir, split, shuffle, seed
+        self.buffer_size, self.rank, self.world_size = buffer_size, rank, world_size
+        self.transform = transform
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info else (0, 1)
+        paths = shard_paths(self.out_dir, self.split, self.shuffle, self.seed, self.epoch,
+                            self.rank * workers + worker, self.world_size * workers)
+        for sample in stream_samples(self.out_dir, self.split, self.shuffle, self.seed,
+                                     self.epoch, readers=1, buffer_size=self.buffer_size,
+                                     rank=self.rank * workers + worker, paths=paths):
+            yield self.transform(sample) if self.transform else sample
+
+
+def unpack(out_dir=shard_dir, dest=dataset_dir, readers=4):
+    # Ultralytics' trainer wants files on disk: stream the shards and lay
+    # them out as images/<split> + labels/<split> on local storage
+    start = time.perf_counter()
+    for split in ("train", "val"):
+        if not index_path(out_dir, split).exists():
+            continue
+        image_dir, label_dir = Path(dest) / "images" / split, Path(dest) / "labels" / split
+        os.makedirs(image_dir, exist_ok=True)
+        os.makedirs(label_dir, exist_ok=True)
+        n = 0
+        for name, image, label in stream_samples(out_dir, split, shuffle=False, readers=readers,
+                                                 decode=False):
+            with open(image_dir / name, "wb") as f:
+                f.write(image)
+            with open(label_dir / (os.path.splitext(name)[0] + ".txt"), "wb") as f:
+                f.write(label)
+            n += 1
+        print(f"{split}: unpacked {n} samples to {image_dir.parent.parent}")
+    print(f"Unpacked in {time.perf_counter() - start:.2f}s")
+
+
+def bench(out_dir=shard_dir, split="train", dataset_dir=dataset_dir, readers=4):
+    # Loose files vs shards, both decoded, one pass each
+    start = time.perf_counter()
+    n_files = 0
+    for path in split_image_paths(dataset_dir, split):
+        decode_sample(os.path.basename(path), *read_sample_files(path))
+        n_files += 1
+    files_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n_shards = sum(1 for _ in stream_samples(out_dir, split, readers=readers))
+    shards_time = time.perf_counter() - start
+    if n_files:
+        print(f"Loose files: {n_files} samples in {files_time:.2f}s "
+              f"({n_files / max(files_time, 1e-9):.1f} samples/sec)")
+    print(f"Shards:      {n_shards} samples in {shards_time:.2f}s "
+          f"({n_shards / max(shards_time, 1e-9):.1f} samples/sec, {readers} readers)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tar shard export and streaming reader")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("export")
+    p.add_argument("--dataset", default=str(dataset_dir))
+    p.add_argument("--out", default=str(shard_dir))
+    p.add_argument("--max-mb", type=float, default=256, help="Upper bound on shard size")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--workers", type=int, default=8, help="File read-ahead threads")
+    p = sub.add_parser("bench")
+    p.add_argument("--out", default=str(shard_dir))
+    p.add_argument("--split", default="train")
+    p.add_argument("--dataset", default=str(dataset_dir))
+    p.add_argument("--readers", type=int, default=4)
+    p = sub.add_parser("unpack")
+    p.add_argument("--out", default=str(shard_dir))
+    p.add_argument("--dest", default=str(dataset_dir))
+    p.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_dataset(args.dataset, args.out, int(args.max_mb * 2**20), args.seed, args.workers)
+    elif args.command == "bench":
+        bench(args.out, args.split, args.dataset, args.readers)
+    else:
+        unpack(args.out, args.dest, args.readers)
+
+
+if __name__ == "__main__":
+    main()
+
+# %%
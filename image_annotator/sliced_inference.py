@@ -0,0 +1,121 @@
+# ------------------------------------------------------------------
+# Description: Sliced (tiled) inference for large substation captures.
+# The image is cut into overlapping tiles that are run through the YOLO
+# model in batches; tile boxes are shifted back to image coordinates and
+# merged with class-aware NMS or weighted box fusion (WBF).
+# Small assets such as circuit breakers (~3% of the image width) keep
+# their pixels this way instead of being lost in a downscale to 640.
+# ------------------------------------------------------------------
+# %%
+import time
+
+import numpy as np
+
+
+def tile_origins(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    origins = list(range(0, length - tile_size, stride))
+    # Last tile is aligned to the border instead of running past it
+    origins.append(length - tile_size)
+    return origins
+
+
+def make_tiles(image, tile_size=640, overlap=0.2):
+    h, w = image.shape[:2]
+    offsets = [
+        (x0, y0)
+        for y0 in tile_origins(h, tile_size, overlap)
+        for x0 in tile_origins(w, tile_size, overlap)
+    ]
+    tiles = [image[y0:y0 + tile_size, x0:x0 + tile_size] for x0, y0 in offsets]
+    return tiles, np.array(offsets, dtype=np.float32)
+
+
+def box_iou(box, boxes):
+    # IoU of one xyxy box against many
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / np.maximum(area + areas - inter, 1e-9)
+
+
+def merge_boxes(boxes, confidences, classes, iou_threshold=0.5, method='nms'):
+    if method not in ('nms', 'wbf'):
+        raise ValueError(f'Unknown merge method: {method}')
+    if len(boxes) == 0:
+        return boxes, confidences, classes
+
+    import torch
+    from torchvision.ops import batched_nms
+    from torchvision.ops import box_iou as iou_matrix
+
+    b = torch.from_numpy(np.ascontiguousarray(boxes, dtype=np.float32))
+    c = torch.from_numpy(np.ascontiguousarray(confidences, dtype=np.float32))
+    k = torch.from_numpy(np.ascontiguousarray(classes)).long()
+    # Class-aware NMS, kept indices in decreasing confidence
+    keep = batched_nms(b, c, k, iou_threshold)
+    if method == 'nms':
+        keep = keep.numpy()
+        return boxes[keep], confidences[keep], classes[keep]
+
+    # Weighted box fusion: each suppressed box joins the first kept box of
+    # its class that overlaps it, the same one that suppressed it in greedy NMS
+    cluster = torch.empty(len(b), dtype=torch.long)
+    cluster[keep] = torch.arange(len(keep))
+    suppressed = torch.ones(len(b), dtype=torch.bool)
+    suppressed[keep] = False
+    suppressed = suppressed.nonzero().squeeze(1)
+    if len(suppressed):
+        overlaps = ((iou_matrix(b[keep], b[suppressed]) > iou_threshold)
+                    & (k[keep, None] == k[None, suppressed]))
+        cluster[suppressed] = overlaps.int().argmax(0)
+    weights = torch.zeros(len(keep)).index_add_(0, cluster, c)
+    fused = torch.zeros(len(keep), 4).index_add_(0, cluster, b * c[:, None]) / weights[:, None]
+    fused_conf = weights / torch.bincount(cluster, minlength=len(keep))
+    keep = keep.numpy()
+    return (fused.numpy().astype(boxes.dtype), fused_conf.numpy().astype(confidences.dtype),
+            classes[keep])
+
+
+def sliced_predict(model, image, tile_size=640, overlap=0.2, batch_size=8, conf=0.25,
+                   iou_threshold=0.5, method='nms', full_image=True, verbose=True, device=None):
+    start = time.perf_counter()
+    tiles, offsets = make_tiles(image, tile_size, overlap)
+
+    boxes, confidences, classes = [], [], []
+    for i in range(0, len(tiles), batch_size):
+        results = model.predict(
+            tiles[i:i + batch_size], imgsz=tile_size, conf=conf, device=device, verbose=False
+        )
+        for result, (x0, y0) in zip(results, offsets[i:i + batch_size]):
+            b = result.boxes.xyxy.cpu().numpy()
+            boxes.append(b + np.array([x0, y0, x0, y0], dtype=b.dtype))
+            confidences.append(result.boxes.conf.cpu().numpy())
+            classes.append(result.boxes.cls.cpu().numpy())
+
+    # One downscaled pass over the whole image for assets larger than a tile
+    if full_image and len(tiles) > 1:
+        result = model.predict(image, imgsz=tile_size, conf=conf, device=device,
+                               verbose=False)[0]
+        boxes.append(result.boxes.xyxy.cpu().numpy())
+        confidences.append(result.boxes.conf.cpu().numpy())
+        classes.append(result.boxes.cls.cpu().numpy())
+
+    boxes, confidences, classes = merge_boxes(
+        np.concatenate(boxes), np.concatenate(confidences), np.concatenate(classes),
+        iou_threshold, method,
+    )
+
+    elapsed = time.perf_counter() - start
+    if verbose:
+        print(f'Sliced inference: {len(tiles)} tiles in {elapsed:.2f}s '
+              f'({len(tiles) / elapsed:.1f} tiles/sec), {len(boxes)} detections')
+    return boxes, classes, confidences
+
+# %%
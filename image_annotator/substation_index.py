@@ -0,0 +1,103 @@
+# ------------------------------------------------------------------
+# Description: Lookup layer over the substation table for the viewer.
+# Built once: a hash index from SS_ID to row position, positional index
+# arrays per SS_TYPE and a KD-tree over lat/lon (as unit vectors, so
+# distances are correct across longitudes) for proximity navigation.
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+import os
+import re
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from prelabel import is_unreviewed_prelabel
+
+ALL_TYPES = "All Types"
+annotation_dirs = (Path("."), Path("Annotations"))
+SCREENSHOT_JSON = re.compile(r"screenshot_(\d+)\.json$")
+
+
+def annotated_ss_ids(dirs=annotation_dirs):
+    # A substation counts as annotated once LabelMe saved its JSON;
+    # pre-labels nobody has reviewed yet do not count
+    ss_ids = set()
+    for d in dirs:
+        if not os.path.isdir(d):
+            continue
+        for entry in os.scandir(d):
+            match = SCREENSHOT_JSON.match(entry.name)
+            if match and not is_unreviewed_prelabel(entry.path):
+                ss_ids.add(int(match.group(1)))
+    return ss_ids
+
+
+def lat_lon_to_xyz(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack(
+        (np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat))
+    )
+
+
+class SubstationIndex:
+    def __init__(self, gdf):
+        self.n = len(gdf)
+        self.ss_ids = gdf["SS_ID"].to_numpy()
+        self.row_of = {ss_id: row for row, ss_id in enumerate(self.ss_ids.tolist())}
+
+        types = gdf["SS_TYPE"].astype(str).to_numpy()
+        self.type_positions = {ALL_TYPES: np.arange(self.n)}
+        for ss_type in np.unique(types):
+            self.type_positions[ss_type] = np.flatnonzero(types == ss_type)
+
+        self.tree = cKDTree(
+            lat_lon_to_xyz(gdf["lat"].to_numpy(np.float64), gdf["lon"].to_numpy(np.float64))
+        )
+        self.annotated = np.zeros(self.n, dtype=bool)
+        self.refresh_annotated()
+
+    def refresh_annotated(self, dirs=annotation_dirs):
+        self.annotated[:] = False
+        for ss_id in annotated_ss_ids(dirs):
+            self.mark_annotated(ss_id)
+
+    def mark_annotated(self, ss_id):
+        row = self.row_of.get(ss_id)
+        if row is not None:
+            self.annotated[row] = True
+
+    def positions(self, ss_type=ALL_TYPES):
+        return self.type_positions.get(ss_type, np.arange(0))
+
+    def locate(self, row, positions):
+        # Index of a row inside a (sorted) filter order, or None
+        i = int(np.searchsorted(positions, row))
+        if i < len(positions) and positions[i] == row:
+            return i
+        return None
+
+    def nearest(self, row, candidates):
+        # Nearest row to `row` among a boolean mask of candidate rows
+        if row is None or not candidates.any():
+            return None
+        point = self.tree.data[row]
+        k = 16
+        while True:
+            k = min(k, self.n)
+            _, rows = self.tree.query(point, k=k)
+            rows = np.atleast_1d(rows)
+            rows = rows[(rows != row) & (rows < self.n)]
+            hits = rows[candidates[rows]]
+            if hits.size:
+                return int(hits[0])
+            if k == self.n:
+                return None
+            k *= 4
+
+    def filter_mask(self, positions):
+        mask = np.zeros(self.n, dtype=bool)
+        mask[positions] = True
+        return mask
+
+# %%
@@ -0,0 +1,155 @@
+# ------------------------------------------------------------------
+# Description: On-disk XYZ tile cache with look-ahead prefetching.
+# Tiles come from a pluggable TileSource (any {z}/{x}/{y} URL template,
+# e.g. a local stand-in tile server) and are stored under cache_dir with
+# least-recently-used eviction once the cache grows past max_bytes.
+# TilePrefetcher warms the tiles around the next substations while the
+# current one is being annotated.
+# ------------------------------------------------------------------
+# %%
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import threading
+import urllib.request
+
+cache_dir = Path("tile_cache")
+TILE_SIZE = 256
+
+
+class TileSource:
+    def __init__(self, url_template, headers=None, timeout=10):
+        self.url_template = url_template
+        self.headers = headers or {"User-Agent": "substation-annotator"}
+        self.timeout = timeout
+
+    def url(self, z, x, y):
+        return self.url_template.format(z=z, x=x, y=y)
+
+    def fetch(self, z, x, y):
+        request = urllib.request.Request(self.url(z, x, y), headers=self.headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+
+class TileCache:
+    def __init__(self, source, cache_dir=cache_dir, max_bytes=2 << 30):
+        self.source = source
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = sum(size for _, _, size in self.scan())
+
+    def path(self, z, x, y):
+        return self.cache_dir / str(z) / str(x) / f"{y}.tile"
+
+    def scan(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".tile"):
+                    path = os.path.join(root, name)
+                    st = os.stat(path)
+                    yield path, st.st_mtime, st.st_size
+
+    def get(self, z, x, y):
+        path = self.path(z, x, y)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # mtime doubles as last-access time for eviction
+        os.utime(path)
+        return data
+
+    def contains(self, z, x, y):
+        return self.path(z, x, y).exists()
+
+    def put(self, z, x, y, data):
+        path = self.path(z, x, y)
+        os.makedirs(path.parent, exist_ok=True)
+        old_size = path.stat().st_size if path.exists() else 0
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes += len(data) - old_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Drop least recently used tiles down to 90% of the budget
+        target = int(self.max_bytes * 0.9)
+        for path, _, size in sorted(self.scan(), key=lambda t: t[1]):
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except FileNotFoundError:
+                pass
+
+    def get_or_fetch(self, z, x, y):
+        data = self.get(z, x, y)
+        if data is None:
+            data = self.source.fetch(z, x, y)
+            self.put(z, x, y, data)
+        return data
+
+
+def lat_lon_to_tile(lat, lon, zoom):
+    # Fractional Web-Mercator tile coordinates
+    n = 2**zoom
+    lat_rad = math.radians(lat)
+    x = (lon + 180) / 360 * n
+    y = (1 - math.asinh(math.tan(lat_rad)) / math.pi) / 2 * n
+    return x, y
+
+
+def tiles_around(lat, lon, zoom, width=1280, height=1280, margin=1):
+    # All tiles covering a width x height viewport centered on lat/lon
+    cx, cy = lat_lon_to_tile(lat, lon, zoom)
+    half_w = width / TILE_SIZE / 2
+    half_h = height / TILE_SIZE / 2
+    n = 2**zoom
+    tiles = []
+    for ty in range(int(cy - half_h) - margin, int(cy + half_h) + margin + 1):
+        if 0 <= ty < n:
+            for tx in range(int(cx - half_w) - margin, int(cx + half_w) + margin + 1):
+                tiles.append((zoom, tx % n, ty))
+    return tiles
+
+
+class TilePrefetcher:
+    def __init__(self, cache, workers=4):
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.generation = 0
+
+    def prefetch(self, centers, zoom=18, width=1280, height=1280):
+        # A new request supersedes tiles still queued from the previous one
+        self.generation += 1
+        generation = self.generation
+        seen = set()
+        for lat, lon in centers:
+            for tile in tiles_around(lat, lon, zoom, width, height):
+                if tile not in seen and not self.cache.contains(*tile):
+                    seen.add(tile)
+                    self.pool.submit(self.fetch, tile, generation)
+        return len(seen)
+
+    def fetch(self, tile, generation):
+        if generation != self.generation or self.cache.contains(*tile):
+            return
+        try:
+            self.cache.get_or_fetch(*tile)
+        except OSError as e:
+            print(f"Could not prefetch tile {tile}: {e}")
+
+    def shutdown(self):
+        self.generation += 1
+        self.pool.shutdown(wait=False)
+
+# %%
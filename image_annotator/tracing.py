@@ -0,0 +1,161 @@
+# ------------------------------------------------------------------
+# Description: Opt-in tracing for the viewer and the data pipeline.
+# Off by default: span() then returns one shared no-op context manager, so
+# an instrumented hot path costs a function call and a flag check. When
+# enabled (trace_file=trace.json in the environment or .env, or enable()),
+# every span is kept as a Chrome trace event (open the file in
+# chrome://tracing or https://ui.perfetto.dev) and the last `window`
+# durations per span name feed a rolling p50/p95 summary.
+# ------------------------------------------------------------------
+# %%
+from collections import deque
+from contextlib import nullcontext
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+enabled = False
+trace_path = None
+window = 1000
+max_events = 1_000_000
+
+events = []
+durations = {}
+lock = threading.Lock()
+NULL_SPAN = nullcontext()
+
+
+def record(name, start_ns, duration_ns, args=None):
+    with lock:
+        if len(events) < max_events:
+            events.append((name, start_ns, duration_ns, threading.get_native_id(), args))
+        if name not in durations:
+            durations[name] = deque(maxlen=window)
+        durations[name].append(duration_ns / 1e6)
+
+
+class Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, time.perf_counter_ns() - self.start, self.args)
+        return False
+
+
+def span(name, **args):
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, args or None)
+
+
+def traced(name=None):
+    # Decorator form for plain functions (not Qt slots, whose arguments
+    # PyQt matches against the signature)
+    def decorate(fn):
+        label = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with Span(label, None):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def now():
+    # Start mark for spans that end in a callback, see complete()
+    return time.perf_counter_ns() if enabled else 0
+
+
+def complete(name, start_ns, **args):
+    if enabled and start_ns:
+        record(name, start_ns, time.perf_counter_ns() - start_ns, args or None)
+
+
+def summary():
+    with lock:
+        snapshot = {name: np.array(d) for name, d in durations.items()}
+    return {
+        name: {
+            "count": len(d),
+            "p50_ms": float(np.percentile(d, 50)),
+            "p95_ms": float(np.percentile(d, 95)),
+            "max_ms": float(d.max()),
+        }
+        for name, d in snapshot.items()
+        if len(d)
+    }
+
+
+def format_summary():
+    lines = [f"{'span':36s} {'n':>6s} {'p50 ms':>9s} {'p95 ms':>9s} {'max ms':>9s}"]
+    for name, s in sorted(summary().items()):
+        lines.append(f"{name:36s} {s['count']:6d} {s['p50_ms']:9.2f} {s['p95_ms']:9.2f} "
+                     f"{s['max_ms']:9.2f}")
+    return "\n".join(lines)
+
+
+def export_chrome(path):
+    pid = os.getpid()
+    with lock:
+        snapshot = list(events)
+    trace_events = []
+    for name, start_ns, duration_ns, tid, args in snapshot:
+        event = {"name": name, "cat": name.split(".", 1)[0], "ph": "X", "pid": pid, "tid": tid,
+                 "ts": start_ns / 1000, "dur": duration_ns / 1000}
+        if args:
+            event["args"] = args
+        trace_events.append(event)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    os.replace(f"{path}.tmp", path)
+    return len(trace_events)
+
+
+def enable(path=None):
+    global enabled, trace_path
+    enabled = True
+    trace_path = path
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with lock:
+        events.clear()
+        durations.clear()
+
+
+def flush():
+    if enabled and durations:
+        print(format_summary())
+        if trace_path:
+            n = export_chrome(trace_path)
+            print(f"Wrote {n} trace events to {trace_path}")
+
+
+if os.getenv("trace_file"):
+    enable(os.getenv("trace_file"))
+    atexit.register(flush)
+
+# %%
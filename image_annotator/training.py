@@ -16,8 +16,21 @@ parent_dir = Path(__file__).resolve().parent.parent
 model = YOLO("yolov8n.yaml")  # build a new model from YAML
 model = YOLO("yolov8n.pt")  # or load a pretrained model
 
+# Decoded, resized images are shared between runs (see image_cache.py).
+# Off until compare_epoch_times below has been run on the real dataset
+use_image_cache = False
+trainer = None
+if use_image_cache:
+    from image_cache import cached_trainer_class
+
+    trainer = cached_trainer_class()
+
 # Train the model
-# results = model.train(data="./data.yml", epochs=100, imgsz=640, device="cuda", save=True)
+# results = model.train(data="./data.yml", epochs=100, imgsz=640, device="cuda", save=True,
+#                       trainer=trainer)
+# Epoch time with and without the cache:
+# from image_cache import compare_epoch_times
+# compare_epoch_times("yolov8n.pt", "./data.yml", epochs=3, imgsz=640, device="cuda")
 
 # %%
 
@@ -35,14 +48,32 @@ image_path = "screenshot_669594105.png"
 image = cv2.imread(str(image_path))
 
 # Perform inference
-results = model(image)
+# Sliced mode tiles large captures so small breakers are not lost in the
+# downscale to 640
+sliced = False
+tile_size, tile_overlap, tile_batch = 640, 0.2, 8
 
-# Visualize the results on the image
-for result in results:
-    boxes = result.boxes.xyxy.cpu().numpy()
-    classes = result.boxes.cls.cpu().numpy()
-    confidences = result.boxes.conf.cpu().numpy()
+if sliced:
+    from sliced_inference import sliced_predict
 
+    detections = [
+        sliced_predict(
+            model, image, tile_size=tile_size, overlap=tile_overlap, batch_size=tile_batch
+        )
+    ]
+else:
+    results = model(image)
+    detections = [
+        (
+            result.boxes.xyxy.cpu().numpy(),
+            result.boxes.cls.cpu().numpy(),
+            result.boxes.conf.cpu().numpy(),
+        )
+        for result in results
+    ]
+
+# Visualize the results on the image
+for boxes, classes, confidences in detections:
     for box, cls, conf in zip(boxes, classes, confidences):
         x1, y1, x2, y2 = box.astype(int)
         label = f"{model.names[int(cls)]}: {conf:.2f}"
@@ -0,0 +1,83 @@
+# ------------------------------------------------------------------
+# Description: Qt widgets shared by the substation viewer (pyqtee.py) and
+# the annotation session. Kept out of pyqtee so that importing them does
+# not re-run the viewer script's module-level setup.
+# ------------------------------------------------------------------
+# %%
+from PyQt5.QtCore import QPoint, QRect, Qt
+from PyQt5.QtGui import QImage, QPainter, QPen, QPixmap
+from PyQt5.QtWidgets import QLabel
+
+
+class CropLabel(QLabel):
+    def __init__(self, pixmap, parent=None):
+        super().__init__(parent)
+        self.setPixmap(pixmap)
+        self.start_point = QPoint()
+        self.end_point = QPoint()
+        self.drawing = False
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.start_point = event.pos()
+            self.end_point = event.pos()
+            self.drawing = True
+            self.update()
+
+    def mouseMoveEvent(self, event):
+        if self.drawing:
+            self.end_point = event.pos()
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.end_point = event.pos()
+            self.drawing = False
+            self.update()
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.start_point.isNull() and not self.end_point.isNull():
+            painter = QPainter(self)
+            painter.setPen(QPen(Qt.red, 2, Qt.DashLine))
+            painter.drawRect(QRect(self.start_point, self.end_point))
+
+    def get_crop_rect(self):
+        x = min(self.start_point.x(), self.end_point.x())
+        y = min(self.start_point.y(), self.end_point.y())
+        width = abs(self.start_point.x() - self.end_point.x())
+        height = abs(self.start_point.y() - self.end_point.y())
+        return QRect(x, y, width, height)
+
+    def get_cropped_pixmap(self, target_size=(1280, 1280)):
+        # Crop the pixmap
+        cropped = self.pixmap().toImage().copy(self.get_crop_rect())
+        return QPixmap.fromImage(scale_and_pad(cropped, target_size))
+
+
+def scale_and_pad(image, target_size=(1280, 1280)):
+    # QImage (unlike QPixmap) may be used off the GUI thread
+    # Resize the cropped image
+    resized = image.scaled(
+        target_size[0], target_size[1], Qt.KeepAspectRatio, Qt.SmoothTransformation
+    )
+
+    # If the resized image is smaller than the target size, pad it
+    if resized.width() != target_size[0] or resized.height() != target_size[1]:
+        padded = QImage(target_size[0], target_size[1], QImage.Format_RGB32)
+        padded.fill(Qt.black)  # Fill with black, you can change this color
+
+        # Calculate position to center the resized image
+        x_offset = (target_size[0] - resized.width()) // 2
+        y_offset = (target_size[1] - resized.height()) // 2
+
+        # Draw the resized image onto the padded image
+        painter = QPainter(padded)
+        painter.drawImage(x_offset, y_offset, resized)
+        painter.end()
+
+        return padded
+
+    return resized
+
+# %%
@@ -0,0 +1,33 @@
+# ------------------------------------------------------------------
+# Description: Dataset path rules shared by the converter, the split and
+# the readers of dataset/ (directory or manifest split). No module-level setup, so DataLoader workers
+# and other importers do not load data.yml.
+# ------------------------------------------------------------------
+# %%
+import os
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def yolo_label_path(image_path):
+    # Same rule Ultralytics uses to find the label of an image
+    sa, sb = f'{os.sep}images{os.sep}', f'{os.sep}labels{os.sep}'
+    return os.path.splitext(sb.join(str(image_path).rsplit(sa, 1)))[0] + '.txt'
+
+
+def split_image_paths(dataset_dir, split):
+    # Sorted image paths of a split written by prepare_annotations: the
+    # <split>.txt list in manifest mode, otherwise <dataset>/images/<split>
+    list_path = os.path.join(dataset_dir, f'{split}.txt')
+    if os.path.exists(list_path):
+        with open(list_path, 'r') as f:
+            return sorted(line.strip() for line in f if line.strip())
+    image_dir = os.path.join(dataset_dir, 'images', split)
+    if not os.path.isdir(image_dir):
+        raise FileNotFoundError(f'No {split} split in {dataset_dir}: '
+                                f'neither {list_path} nor {image_dir} exists')
+    return sorted(
+        e.path for e in os.scandir(image_dir) if e.name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+# %%